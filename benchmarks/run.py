@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks the nomisweb, NRScotland and NISRA APIs against a local stand-in server (see server.py), so the results
+are reproducible and independent of the network and the providers' sites.
+Each benchmark is timed (the best of several repeats) and its memory usage measured in a separate run, in a forked
+process: the peak resident set size (RSS) of the process, and how much the benchmark itself increased it. (Unlike
+tracemalloc, this includes native allocations, e.g. by Arrow.) The results are appended to a file (one json record per
+run) so they can be compared across releases. Requires a unix-like platform.
+
+Usage: python benchmarks/run.py [--areas N] [--repeats N] [--output FILE] [--filter SUBSTRING]
+"""
+
+import os
+import sys
+import io
+import json
+import time
+import shutil
+import argparse
+import contextlib
+import platform
+import resource
+import tempfile
+import multiprocessing
+from datetime import datetime
+
+import ukcensusapi
+import ukcensusapi.Nomisweb as ApiEW
+import ukcensusapi.NRScotland as ApiSC
+import ukcensusapi.NISRA as ApiNI
+import ukcensusapi.transport as transport
+
+import server
+
+RESOLUTIONS = ["LAD", "MSOA11", "LSOA11", "OA11"]
+
+# (results recorded without a row limit used this)
+ROW_LIMIT = ApiEW.Nomisweb.RowLimit
+
+class Benchmark:
+  """
+  setup() prepares (untimed) the state, which is passed to run(), whose return value is the number of items (e.g. rows)
+  processed, from which the throughput is computed
+  """
+  def __init__(self, name, setup, run):
+    self.name = name
+    self.setup = setup
+    self.run = run
+
+class Cache:
+  """
+  Creates fresh cache directories, optionally pre-populated, and removes them all on exit
+  """
+  def __init__(self, geography):
+    self.root = tempfile.mkdtemp(prefix="ukcensusapi-bench-")
+    self.sc_lookup = geography.sc_lookup
+    self.ew_lookup = geography.ew_lookup()
+
+  def new(self):
+    # (unique, as they are also created in the forked processes used to measure memory)
+    cache_dir = tempfile.mkdtemp(dir=self.root)
+    # NRScotland.make_sc_lookup downloads from fixed urls so can't be redirected to the stand-in
+    self.sc_lookup.to_csv(os.path.join(cache_dir, "sc_lookup.csv"), index=False)
+    # (for rollup)
+    self.ew_lookup.to_csv(os.path.join(cache_dir, "ew_lookup.csv"), index=False)
+    return cache_dir
+
+  def close(self):
+    shutil.rmtree(self.root, ignore_errors=True)
+
+def _query(api, resolution, lads=None):
+  """
+  Query for every area at the resolution: as a list of area codes, or if lads are specified, all the areas of that type in
+  each (the <lad>TYPE<type> form, needed for rollup)
+  """
+  meta = api.load_metadata(server.TABLE + "EW")
+  type_code = ApiEW.Nomisweb.GeoCodeLookup[resolution]
+  return {"date": "latest",
+          "geography": api.get_geo_codes(ApiEW.Nomisweb.GeoCodeLookup["EnglandWales"], type_code) if lads is None else
+                       ",".join("%dTYPE%s" % (lad, type_code[4:]) for lad in lads),
+          "CELL": ",".join(str(cell) for cell in meta["fields"]["CELL"]),
+          "RURAL_URBAN": "0",
+          "MEASURES": "20100",
+          "select": "GEOGRAPHY_CODE,CELL,OBS_VALUE"}
+
+def benchmarks(cache, geography):
+  """
+  Returns the list of benchmarks
+  """
+  table = server.TABLE
+  ew_table = table + "EW"
+  lads = geography.ew["LAD"].id.tolist()
+  result = [Benchmark("ew.get_metadata",
+                      lambda: ApiEW.Nomisweb(cache.new()),
+                      lambda api: len(api.get_metadata(ew_table)["fields"]))]
+
+  for resolution in RESOLUTIONS:
+    result.append(Benchmark("ew.get_geo_codes[%s]" % resolution,
+                            lambda: ApiEW.Nomisweb(cache.new()),
+                            lambda api, resolution=resolution:
+                              len(ApiEW._expand(api.get_geo_codes(lads, ApiEW.Nomisweb.GeoCodeLookup[resolution])))))
+
+  def ew_cold(resolution):
+    api = ApiEW.Nomisweb(cache.new())
+    return api, _query(api, resolution)
+
+  def ew_warm(resolution):
+    api, query = ew_cold(resolution)
+    api.get_data(ew_table, query)
+    return ApiEW.Nomisweb(api.cache_dir), query
+
+  for resolution in RESOLUTIONS:
+    result.append(Benchmark("ew.get_data.cold[%s]" % resolution,
+                            lambda resolution=resolution: ew_cold(resolution),
+                            lambda state: len(state[0].get_data(ew_table, state[1]))))
+    result.append(Benchmark("ew.get_data.warm[%s]" % resolution,
+                            lambda resolution=resolution: ew_warm(resolution),
+                            lambda state: len(state[0].get_data(ew_table, state[1]))))
+
+  # aggregated from cached output area data
+  def ew_rollup(resolution):
+    api = ApiEW.Nomisweb(cache.new())
+    api.get_data(ew_table, _query(api, "OA11", lads))
+    return api, _query(api, resolution, lads)
+
+  for resolution in RESOLUTIONS[:-1]:
+    result.append(Benchmark("ew.get_data.rollup[%s]" % resolution,
+                            lambda resolution=resolution: ew_rollup(resolution),
+                            lambda state: len(state[0].get_data(ew_table, state[1], rollup=True))))
+
+  # the archives are downloaded and parsed when cold, only the cached tables are read when warm
+  for name, api_type, coverage in [("sc", ApiSC.NRScotland, "S92000003"), ("ni", ApiNI.NISRA, "N92000002")]:
+    nation_table = table + name.upper()
+
+    def cold(api_type=api_type):
+      return api_type(cache.new())
+
+    def warm(api_type=api_type, nation_table=nation_table, coverage=coverage):
+      api = api_type(cache.new())
+      for res in RESOLUTIONS:
+        api.get_data(nation_table, coverage, res)
+      return api_type(api.cache_dir)
+
+    for resolution in RESOLUTIONS:
+      run = lambda api, nation_table=nation_table, coverage=coverage, resolution=resolution: \
+        len(api.get_data(nation_table, coverage, resolution))
+      result.append(Benchmark("%s.get_data.cold[%s]" % (name, resolution), cold, run))
+      result.append(Benchmark("%s.get_data.warm[%s]" % (name, resolution), warm, run))
+  return result
+
+def _max_rss_mb():
+  # (reported in kilobytes on linux, bytes on macOS)
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1e6 if sys.platform == "darwin" else 1e3)
+
+def _measure_memory(benchmark, results):
+  """
+  Runs in a (forked) process: reports its peak RSS after the setup, and after the benchmark
+  """
+  try:
+    with contextlib.redirect_stdout(io.StringIO()):
+      state = benchmark.setup()
+      before = _max_rss_mb()
+      benchmark.run(state)
+    results.put((before, _max_rss_mb()))
+  except Exception as error:
+    results.put(error)
+
+def measure(benchmark, repeats):
+  """
+  Returns the best time, the number of items processed, the peak RSS, and the increase in it due to the benchmark
+  """
+  seconds = None
+  # the providers' progress reports are discarded
+  with contextlib.redirect_stdout(io.StringIO()):
+    for _ in range(repeats):
+      state = benchmark.setup()
+      start = time.perf_counter()
+      items = benchmark.run(state)
+      elapsed = time.perf_counter() - start
+      seconds = elapsed if seconds is None else min(seconds, elapsed)
+
+  # so no pooled connections are shared with the forked process
+  transport.configure()
+  context = multiprocessing.get_context("fork")
+  results = context.Queue()
+  process = context.Process(target=_measure_memory, args=(benchmark, results))
+  process.start()
+  memory = results.get()
+  process.join()
+  if isinstance(memory, Exception):
+    raise memory
+  before, peak = memory
+  return {"seconds": seconds, "items": items, "per_second": items / seconds if seconds else None,
+          "peak_mb": peak, "increase_mb": peak - before}
+
+def _previous(output, areas, row_limit):
+  """
+  The most recent recorded results with the same number of areas and row limit (i.e. comparable)
+  """
+  if not os.path.isfile(output):
+    return None
+  with open(output) as fd:
+    records = [json.loads(line) for line in fd if line.strip()]
+  return next((record for record in reversed(records)
+               if record["areas"] == areas and record.get("row_limit", ROW_LIMIT) == row_limit), None)
+
+def _report(name, results, previous):
+  line = "%-28s %10.4fs %10d %12.0f/s %9.1fMB %9.1fMB" % (name, results["seconds"], results["items"], results["per_second"] or 0,
+                                                          results["peak_mb"], results["increase_mb"])
+  # (memory is only comparable with results that measured RSS)
+  if previous and name in previous["results"] and "increase_mb" in previous["results"][name]:
+    line += "  (%+.0f%% time, %+.0f%% memory vs %s)" % (100 * (results["seconds"] / previous["results"][name]["seconds"] - 1),
+                                                         100 * (results["peak_mb"] / max(previous["results"][name]["peak_mb"], 1e-6) - 1),
+                                                         previous["version"])
+  print(line)
+
+def main():
+  parser = argparse.ArgumentParser(description="UKCensusAPI benchmarks (offline, using a local stand-in server)")
+  parser.add_argument("--areas", type=int, default=10, help="number of local authorities per nation (default 10)")
+  parser.add_argument("--repeats", type=int, default=3, help="timing repeats (default 3)")
+  parser.add_argument("--output", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "results.jsonl"),
+                      help="file to append the results to (default benchmarks/results.jsonl)")
+  parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+  parser.add_argument("--row-limit", type=int, default=ROW_LIMIT,
+                      help="nomisweb's row limit, also applied by the stand-in: lower it to benchmark query splitting and "
+                           "paging (default %d)" % ROW_LIMIT)
+  args = parser.parse_args()
+  ApiEW.Nomisweb.RowLimit = args.row_limit
+
+  # the stand-in doesn't check the key, but the providers require one when online
+  os.environ.setdefault("NOMIS_API_KEY", "benchmark")
+
+  stand_in = server.start(args.areas)
+  server.point_to(stand_in.url)
+  cache = Cache(stand_in.stand_in.geography)
+  previous = _previous(args.output, args.areas, args.row_limit)
+
+  record = {"version": ukcensusapi.__version__,
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "areas": args.areas,
+            "row_limit": args.row_limit,
+            "results": {}}
+  print("%-28s %11s %10s %14s %11s %11s" % ("benchmark", "time", "items", "throughput", "peak RSS", "increase"))
+  try:
+    for benchmark in benchmarks(cache, stand_in.stand_in.geography):
+      if args.filter in benchmark.name:
+        record["results"][benchmark.name] = measure(benchmark, args.repeats)
+        _report(benchmark.name, record["results"][benchmark.name], previous)
+  finally:
+    cache.close()
+    stand_in.shutdown()
+
+  with open(args.output, "a") as fd:
+    fd.write(json.dumps(record) + "\n")
+  print("Results appended to %s" % args.output)
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,313 @@
+"""
+A local stand-in for the nomisweb API and the NRScotland and NISRA download sites, serving synthetic (but
+consistently structured) responses, so that the package can be benchmarked without network access.
+Use point_to() to redirect the providers to a running server.
+"""
+
+import io
+import sys
+import json
+import string
+import zipfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl, unquote
+import numpy as np
+import pandas as pd
+
+import ukcensusapi.Nomisweb as ApiEW
+import ukcensusapi.NRScotland as ApiSC
+import ukcensusapi.NISRA as ApiNI
+
+# the synthetic table, which has the same name (and structure) in every nation
+TABLE = "KS101"
+
+# nomis internal name of the synthetic table
+NOMIS_TABLE = "NM_9001_1"
+
+# categories of the synthetic table
+CELLS = ["All usual residents", "Males", "Females", "Aged 0 to 15", "Aged 16 to 64", "Aged 65 and over",
+         "Lives in a household", "Lives in a communal establishment"]
+RURAL_URBAN = ["Total", "Urban", "Rural"]
+
+# areas each area contains at the next finest level (e.g. each LAD contains 20 MSOAs), roughly as the real geographies
+EWBranching = [20, 5, 5]
+SCBranching = [40, 5, 7]
+NIBranching = [22, 2, 5]
+
+def _values(n, seed):
+  """
+  Deterministic pseudo-random counts
+  """
+  return np.random.RandomState(seed).randint(0, 5000, size=n)
+
+class Geography:
+  """
+  Synthetic nested geographies for each nation, with the same structure as the real ones.
+  """
+  def __init__(self, areas=10):
+    """
+    Args:
+      areas: the number of local authorities in each nation
+    """
+    # E&W: nomis integer codes and ONS codes, for each of LAD, MSOA11, LSOA11, OA11
+    self.ew = {}
+    levels = list(zip(["LAD", "MSOA11", "LSOA11", "OA11"], [1946157057, 1245708000, 1249900000, 1254100000], ["E08", "E02", "E01", "E00"]))
+    counts = np.cumprod([areas] + EWBranching)
+    for (level, base, prefix), count in zip(levels, counts):
+      ids = np.arange(base, base + count)
+      self.ew[level] = pd.DataFrame({"id": ids, "code": ["%s%06d" % (prefix, i) for i in range(count)],
+                                     "lad": np.arange(count) // (count // areas)})
+
+    # Scotland: OA-DZ-IZ-CA lookup, as sc_lookup.csv
+    counts = np.cumprod([areas] + SCBranching)
+    n = counts[-1]
+    oa = np.arange(n)
+    self.sc_lookup = pd.DataFrame({"OutputArea": ["S00%06d" % i for i in oa],
+                                   "DataZone": ["S01%06d" % i for i in oa // SCBranching[2]],
+                                   "InterZone": ["S02%06d" % i for i in oa // (SCBranching[2] * SCBranching[1])],
+                                   "Council": ["S12%06d" % i for i in oa // (n // areas)]})
+
+    # NI: SA-SOA-WARD-LGD lookup, as NI_HIERARCHY.csv
+    lgds = ["95" + string.ascii_uppercase[i // 26] + string.ascii_uppercase[i % 26] for i in range(areas)]
+    counts = np.cumprod([areas] + NIBranching)
+    n = counts[-1]
+    sa = np.arange(n)
+    ward = sa // (NIBranching[2] * NIBranching[1])
+    lgd = sa // (n // areas)
+    soa = sa // NIBranching[2] % NIBranching[1]
+    ward_in_lgd = ward % NIBranching[0]
+    self.ni_lookup = pd.DataFrame({"SA": ["N00%06d" % i for i in sa],
+                                   "SOA": ["%s%02dS%d" % (lgds[l], w + 1, s + 1) for l, w, s in zip(lgd, ward_in_lgd, soa)],
+                                   "WARD": ["%s%02d" % (lgds[l], w + 1) for l, w in zip(lgd, ward_in_lgd)],
+                                   "LGD": [lgds[l] for l in lgd],
+                                   "NUTS3": "N09000001", "HSCT": "N09000002", "ELB": "N09000003", "COUNTRY": "N92000002"})
+
+  def ew_lookup(self):
+    """
+    The E&W OA-LSOA-MSOA-LAD lookup (ONS codes), as ew_lookup.csv
+    """
+    lsoa = np.arange(len(self.ew["OA11"])) // EWBranching[2]
+    msoa = lsoa // EWBranching[1]
+    return pd.DataFrame({"OA11": self.ew["OA11"].code.values,
+                         "LSOA11": self.ew["LSOA11"].code.values[lsoa],
+                         "MSOA11": self.ew["MSOA11"].code.values[msoa],
+                         "LAD": self.ew["LAD"].code.values[self.ew["OA11"].lad.values]})
+
+  def nomis_codes(self, la_code, code_type):
+    """
+    The nomis codes of the areas of type code_type within la_code (a LAD or country)
+    """
+    level = next(level for level, type_code in ApiEW.Nomisweb.GeoCodeLookup.items() if type_code == code_type)
+    areas = self.ew[level]
+    if str(la_code) == ApiEW.Nomisweb.GeoCodeLookup["EnglandWales"]:
+      return areas
+    lad = self.ew["LAD"].index[self.ew["LAD"].id == int(la_code)]
+    return areas[areas.lad.isin(lad)]
+
+class StandIn:
+  """
+  Builds the responses for each endpoint
+  """
+  def __init__(self, areas=10):
+    self.geography = Geography(areas)
+    self.__ew_codes = pd.concat(self.geography.ew.values()).set_index("id").code
+    self.zips = {}
+    self.__zips_lock = threading.Lock()
+
+  # nomisweb
+
+  def nomis_json(self, path, query):
+    """
+    The SDMX json for a nomisweb metadata endpoint, or None if not found
+    """
+    if path == "api/v01/dataset/def.sdmx.json":
+      if TABLE + "EW" not in query.get("search", ""):
+        return {"structure": {"keyfamilies": None}}
+      dimensions = [{"conceptref": field} for field in ["GEOGRAPHY", "RURAL_URBAN", "CELL", "MEASURES", "FREQ"]]
+      return {"structure": {"keyfamilies": {"keyfamily": [{"id": NOMIS_TABLE,
+                                                            "name": {"value": TABLE + "EW - Usual resident population"},
+                                                            "components": {"dimension": dimensions}}]}}}
+    prefix = "api/v01/dataset/" + NOMIS_TABLE + "/"
+    if path == prefix + "geography/TYPE.def.sdmx.json":
+      return _codelist([(type_code, level) for level, type_code in ApiEW.Nomisweb.GeoCodeLookup.items() if type_code.startswith("TYPE")])
+    if path.startswith(prefix) and path.endswith(".def.sdmx.json"):
+      field = path[len(prefix):-len(".def.sdmx.json")]
+      values = {"GEOGRAPHY": [(ApiEW.Nomisweb.GeoCodeLookup["EnglandWales"], "England and Wales")],
+                "RURAL_URBAN": list(enumerate(RURAL_URBAN)),
+                "CELL": list(enumerate(CELLS)),
+                "MEASURES": [(20100, "value")],
+                "FREQ": [("A", "Annually")]}.get(field)
+      return _codelist(values) if values else None
+    prefix = "api/v01/dataset/NM_144_1/geography/"
+    if path.startswith(prefix):
+      la_code, code_type = path[len(prefix):-len(".def.sdmx.json")].split("TYPE")
+      areas = self.geography.nomis_codes(la_code, "TYPE" + code_type)
+      return _codelist(zip(areas.id, areas.code))
+    return None
+
+  def nomis_tsv(self, query):
+    """
+    The tab-separated data for a nomisweb data query
+    """
+    params = {k.upper(): v for k, v in query.items()}
+    areas = self.__ew_codes
+    ids = self.__geography_ids(params["GEOGRAPHY"])
+    cells = ApiEW._expand(params.get("CELL", "0...%d" % (len(CELLS) - 1)))
+    rural_urban = ApiEW._expand(params.get("RURAL_URBAN", "0...%d" % (len(RURAL_URBAN) - 1)))
+
+    n = len(ids) * len(cells) * len(rural_urban)
+    data = pd.DataFrame({"GEOGRAPHY": np.repeat(ids, len(cells) * len(rural_urban)),
+                         "RURAL_URBAN": np.tile(np.repeat(rural_urban, len(cells)), len(ids)),
+                         "CELL": np.tile(cells, len(ids) * len(rural_urban))})
+    data["GEOGRAPHY_CODE"] = areas.loc[data.GEOGRAPHY].values
+    data["MEASURES"] = 20100
+    data["OBS_VALUE"] = _values(n, len(ids))
+    offset = int(params.get("RECORDOFFSET", 0))
+    data = data.iloc[offset:offset + ApiEW.Nomisweb.RowLimit]
+    columns = params["SELECT"].split(",") if "SELECT" in params else list(data.columns)
+    return data[columns].to_csv(sep="\t", index=False).encode()
+
+  # area codes, in shortened form, and/or all the areas of a type within a LAD or country (<code>TYPE<type>)
+  def __geography_ids(self, geography):
+    ids = []
+    for item in geography.split(","):
+      if "TYPE" in item:
+        la_code, code_type = item.split("TYPE")
+        ids.extend(self.geography.nomis_codes(la_code, "TYPE" + code_type).id)
+      else:
+        ids.extend(ApiEW._expand(item))
+    return ids
+
+  # NRScotland and NISRA
+
+  def zip(self, name):
+    """
+    The (cached) content of a bulk data archive, or None if not found
+    """
+    with self.__zips_lock:
+      if name not in self.zips:
+        content = self.__sc_zip(name) if name in self.__sc_sources() else self.__ni_zip(name)
+        if content is None:
+          return None
+        self.zips[name] = content
+      return self.zips[name]
+
+  def __sc_sources(self):
+    return {ApiSC.NRScotland.data_sources[0].lower().replace(" ", "-"): "Council",
+            ApiSC.NRScotland.data_sources[1]: "DataZone",
+            ApiSC.NRScotland.data_sources[2]: "OutputArea"}
+
+  def __sc_zip(self, name):
+    level = self.__sc_sources()[name]
+    areas = self.geography.sc_lookup[level].unique()
+    sexes = ["All people", "Males", "Females"]
+    values = _values(len(areas) * len(sexes) * len(CELLS), len(areas)).reshape(-1, len(CELLS))
+    data = pd.DataFrame(values)
+    data.insert(0, "geography", np.repeat(areas, len(sexes)))
+    data.insert(1, "sex", np.tile(sexes, len(areas)))
+    # as the real data, the geography and category columns are unnamed
+    csv = ",," + ",".join(CELLS) + "\n" + data.to_csv(index=False, header=False)
+    return _zip({TABLE + "SC.csv": csv})
+
+  def __ni_zip(self, name):
+    if name not in ApiNI.NISRA.data_sources:
+      return None
+    members = {}
+    if name == ApiNI.NISRA.data_sources[2]:
+      members["All_Geographies_Code_Files/NI_HIERARCHY.csv"] = self.geography.ni_lookup.to_csv(index=False)
+    if name == ApiNI.NISRA.data_sources[ApiNI.NISRA.source_map[TABLE[:2]]]:
+      codes = [TABLE + "NI%04d" % i for i in range(len(CELLS))]
+      members.update({
+        folder + "/" + TABLE + "NIDESC0.CSV":
+          pd.DataFrame({"ColumnVariableCode": codes, "ColumnVariableMeasurementUnit": "Count",
+                        "ColumnVariableStatisticalUnit": "Person", "ColumnVariableDescription": CELLS}).to_csv(index=False)
+        for folder in ApiNI.NISRA.res_map.values()})
+      for resolution, folder in ApiNI.NISRA.res_map.items():
+        areas = self.geography.ni_lookup[resolution].unique()
+        data = pd.DataFrame(_values(len(areas) * len(codes), len(areas)).reshape(-1, len(codes)), columns=codes)
+        data.insert(0, "GeographyCode", areas)
+        members[folder + "/" + TABLE + "NIDATA0.CSV"] = data.to_csv(index=False)
+    return _zip(members)
+
+def _codelist(values):
+  codes = [{"value": value, "description": {"value": description},
+            "annotations": {"annotation": [{}, {}, {"annotationtext": description}]}} for value, description in values]
+  return {"structure": {"codelists": {"codelist": [{"code": codes}]}}}
+
+def _zip(members):
+  buffer = io.BytesIO()
+  with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+    for member, content in members.items():
+      archive.writestr(member, content)
+  return buffer.getvalue()
+
+class _Handler(BaseHTTPRequestHandler):
+  # keep-alive, as the real sites
+  protocol_version = "HTTP/1.1"
+
+  def do_GET(self):
+    url = urlsplit(self.path)
+    query = dict(parse_qsl(url.query))
+    site, _, path = unquote(url.path).lstrip("/").partition("/")
+    stand_in = self.server.stand_in
+
+    content, content_type = None, "application/octet-stream"
+    if not path:
+      # site root, used to check the site is online
+      content, content_type = b"OK", "text/plain"
+    elif site == "nomis" and path.endswith(".data.tsv"):
+      content, content_type = stand_in.nomis_tsv(query), "text/tab-separated-values"
+    elif site == "nomis":
+      reply = stand_in.nomis_json(path, query)
+      if reply is not None:
+        content, content_type = json.dumps(reply).encode(), "application/json"
+    elif site == "sc" and path.endswith(".zip"):
+      content = stand_in.zip(path.split("/")[-1][:-len(".zip")])
+    elif site == "ni":
+      # (the NI source names include the extension)
+      content = stand_in.zip(path)
+
+    if content is None:
+      self.send_error(404)
+      return
+    self.send_response(200)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Content-Length", str(len(content)))
+    self.end_headers()
+    self.wfile.write(content)
+
+  def log_message(self, format, *args):
+    pass
+
+class _Server(ThreadingHTTPServer):
+  daemon_threads = True
+
+  def handle_error(self, request, client_address):
+    # clients closing pooled keep-alive connections isn't an error
+    if not isinstance(sys.exc_info()[1], ConnectionError):
+      super().handle_error(request, client_address)
+
+def start(areas=10, port=0):
+  """
+  Starts the server (on a background thread)
+  Args:
+    areas: the number of local authorities in each nation
+    port: the port (default any free port)
+  Returns:
+    the server, whose base url is server.url. Call server.shutdown() to stop it
+  """
+  server = _Server(("127.0.0.1", port), _Handler)
+  server.stand_in = StandIn(areas)
+  server.url = "http://127.0.0.1:%d/" % server.server_address[1]
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server
+
+def point_to(url):
+  """
+  Redirects all the providers to the stand-in server at url
+  """
+  ApiEW.Nomisweb.URL = url + "nomis/"
+  ApiSC.NRScotland.URL = ApiSC.NRScotland.URL1 = url + "sc/"
+  ApiSC.NRScotland.URL2 = url + "sc/downloads/"
+  ApiNI.NISRA.URL = url + "ni/"
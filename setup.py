@@ -20,6 +20,7 @@ setuptools.setup(name='ukcensusapi',
                     'requests',
                     'openpyxl',
                     'xlrd'],
+  extras_require={'arrow': ['pyarrow'], 'deflate64': ['zipfile-deflate64']},
   classifiers=(
     "Programming Language :: Python :: 3",
     "License :: OSI Approved :: MIT License",
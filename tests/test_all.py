@@ -7,6 +7,7 @@ import sys
 import pytest
 
 from ukcensusapi import Nomisweb as Api_EW, NRScotland as Api_SC, NISRA as Api_NI, Query as Census
+from ukcensusapi import cache, hierarchy
 
 CACHE_DIR = "/tmp/UKCensusAPI"
 
@@ -159,6 +160,69 @@ def test_get_data_ew(api_ew):
   assert sum(table.OBS_VALUE) == 8214
 
 
+def test_get_data_incremental(api_ew):
+  query_params = {
+    "CELL": "7...13",
+    "date": "latest",
+    "RURAL_URBAN": "0",
+    "select": "GEOGRAPHY_CODE,CELL,OBS_VALUE",
+    "geography": "1245710558...1245710559",
+    "MEASURES": "20100"
+  }
+  table = api_ew.get_data("KS401EW", query_params, incremental=True)
+  assert table.shape == (14, 3)
+  # only the extra area is downloaded, the result should be the same as the non-incremental query
+  query_params["geography"] = "1245710558...1245710560"
+  table = api_ew.get_data("KS401EW", query_params, incremental=True)
+  assert table.shape == (21, 3)
+  assert sum(table.OBS_VALUE) == 8214
+
+
+def test_get_data_rollup(tmp_path):
+  api = Api_EW.Nomisweb(str(tmp_path))
+  query_params = {
+    "CELL": "7...13",
+    "date": "latest",
+    "RURAL_URBAN": "0",
+    "select": "GEOGRAPHY_CODE,CELL,OBS_VALUE",
+    "geography": "1946157057TYPE299",
+    "MEASURES": "20100"
+  }
+  oa = api.get_data("KS401EW", query_params)
+  # (partial) lookup for the output areas, all in the same LAD
+  lookup_file = str(tmp_path / "lookup.csv")
+  with open(lookup_file, "w") as f:
+    f.write("OA11CD,LSOA11CD,MSOA11CD,LAD11CD\n")
+    for code in oa.GEOGRAPHY_CODE.unique():
+      f.write("%s,L,M,E06000001\n" % code)
+  api.make_ew_lookup(lookup_file)
+  query_params["geography"] = "1946157057TYPE464"
+  lad = api.get_data("KS401EW", query_params, rollup=True)
+  assert lad.shape == (7, 3)
+  assert list(lad.GEOGRAPHY_CODE.unique()) == ["E06000001"]
+  assert sum(lad.OBS_VALUE) == sum(oa.OBS_VALUE)
+
+
+def test_get_data_many_async():
+  import asyncio
+  from ukcensusapi import AsyncNomisweb as Api_EW_async
+  query_params = {
+    "CELL": "7...13",
+    "date": "latest",
+    "RURAL_URBAN": "0",
+    "select": "GEOGRAPHY_CODE,CELL,OBS_VALUE",
+    "geography": "1245710558...1245710560",
+    "MEASURES": "20100"
+  }
+  async def get_data():
+    async with Api_EW_async.AsyncNomisweb(CACHE_DIR) as api:
+      return await api.get_data_many([("KS401EW", query_params), ("KS401EW", dict(query_params, CELL="7"))])
+  tables = asyncio.run(get_data())
+  assert tables[0].shape == (21, 3)
+  assert sum(tables[0].OBS_VALUE) == 8214
+  assert tables[1].shape == (3, 3)
+
+
 def test_get_data_sc(api_sc):
   table_name = "KS401SC"
   geography = "S12000033" # Aberdeen
@@ -192,6 +256,20 @@ def test_get_data_ni(api_ni):
   assert table.shape == (96, 3)
   assert sum(table.OBS_VALUE) == 14817
 
+def test_get_data_uk(api_sc, api_ni):
+  from ukcensusapi import UKCensus as Api_UK
+  uk = Api_UK.UKCensus(CACHE_DIR)
+  table = uk.get_data("KS401", "LAD", ["E06000001", "S12000033", "95AA"])
+  assert list(table.columns) == ["NATION", "TABLE", "GEOGRAPHY_CODE", "CATEGORY", "OBS_VALUE"]
+  assert list(table.NATION.unique()) == ["EW", "SC", "NI"]
+  assert list(table[table.NATION == "EW"].GEOGRAPHY_CODE.unique()) == ["E06000001"]
+  assert sum(table[table.NATION == "SC"].OBS_VALUE) == sum(api_sc.get_data("KS401SC", "S12000033", "LAD").OBS_VALUE)
+  assert sum(table[table.NATION == "NI"].OBS_VALUE) == sum(api_ni.get_data("KS401NI", "95AA", "LAD").OBS_VALUE)
+  assert not table.CATEGORY.isnull().any()
+
+  with pytest.raises(ValueError):
+    uk.get_data("KS401", "WARD")
+
 #'table': 'QS202NI', 'description': '', 'geography': 'SOA', 'fields': {'QS202NI_0_CODE': {0: 'All Household Reference Persons (HRPs)', 1: 'Ethnic group of HRP: Black', 2: 'Ethnic group of HRP: Chinese', 3: 'Ethnic group of HRP: Mixed', 4: 'Ethnic group of HRP: Other', 5: 'Ethnic group of HRP: Other Asian', 6: 'Ethnic group of HRP: White'}}}
 
 # OD data is structured differently
@@ -329,3 +407,425 @@ def test_shorten_codelist():
   for _ in range(0,100):
     short = Api_EW._shorten(sample(n, len(n)))
     assert short == "1...3,5...17,20"
+
+# checks the inverse of the above, and splitting of a codelist into pieces
+def test_expand_split_codelist():
+  assert Api_EW._expand("1...3,5...17,20") == list(range(1,4)) + list(range(5,18)) + [20]
+  assert Api_EW._expand("7") == [7]
+  with pytest.raises(ValueError):
+    Api_EW._expand("2092957703TYPE464")
+
+  pieces = Api_EW._split_codes("1...3,5...17,20", 2)
+  assert pieces == ["1...3,5...10", "11...17,20"]
+  assert sum(len(Api_EW._expand(p)) for p in Api_EW._split_codes("1...1000", 7)) == 1000
+  assert Api_EW._split_codes("1", 4) == ["1"]
+
+
+# a query predicted to exceed the row limit is split by geography, and then (per area) paged
+def test_get_data_split(tmp_path, monkeypatch):
+  import json
+  import pandas as pd
+  from urllib.parse import urlsplit, parse_qsl
+  queries = []
+  def download(url, filename):
+    query = dict(parse_qsl(urlsplit(url).query))
+    queries.append(query)
+    data = pd.DataFrame([(g, c, g * 100 + c) for g in Api_EW._expand(query.get("geography", "1")) for c in Api_EW._expand(query["CELL"])],
+                        columns=["GEOGRAPHY_CODE", "CELL", "OBS_VALUE"])
+    offset = int(query.get("RecordOffset", 0))
+    data.iloc[offset:offset + Api_EW.Nomisweb.RowLimit].to_csv(str(filename), sep="\t", index=False)
+  monkeypatch.setenv("NOMIS_API_KEY", "test")
+  monkeypatch.setattr(Api_EW.Nomisweb, "RowLimit", 10)
+  monkeypatch.setattr(Api_EW.transport, "download", download)
+  with open(str(tmp_path / "T_metadata.json"), "w") as fd:
+    json.dump({"nomis_table": "NM_1_1", "description": "", "fields": {"GEOGRAPHY": {}, "CELL": {}}, "geographies": {}}, fd)
+  query = {"geography": "1,2", "CELL": "1...25", "select": "GEOGRAPHY_CODE,CELL,OBS_VALUE"}
+  api = Api_EW.Nomisweb(str(tmp_path))
+  api._Nomisweb__offline_mode = False
+  assert api.get_data("T", dict(query, geography="1")).shape == (25, 3)
+
+  # with only one of the pieces cached, an offline query fails rather than returning (and caching) half the data
+  cached = set(tmp_path.iterdir())
+  assert Api_EW.Nomisweb(str(tmp_path), offline=True).get_data("T", query) is None
+  assert not [f for f in set(tmp_path.iterdir()) - cached if f.suffix == ".tsv"]
+
+  # online, only the missing piece is downloaded
+  del queries[:]
+  table = api.get_data("T", query)
+  assert table.shape == (50, 3)
+  assert sorted(table.OBS_VALUE) == [g * 100 + c for g in [1, 2] for c in range(1, 26)]
+  assert queries and all(q["geography"] == "2" for q in queries)
+
+  # a truncated result is paged, reusing the data already received as the first page
+  del queries[:]
+  table = api.get_data("T", {"CELL": "1...25", "select": "GEOGRAPHY_CODE,CELL,OBS_VALUE"})
+  assert sorted(table.OBS_VALUE) == [100 + c for c in range(1, 26)]
+  assert [q.get("RecordOffset", "0") for q in queries].count("0") == 1
+
+# cached data for all of a dimension's values (i.e. the dimension omitted from the query) answers queries for some of them
+def test_get_data_superset(tmp_path, monkeypatch):
+  import json
+  import pandas as pd
+  from urllib.parse import urlsplit, parse_qsl
+  queries = []
+  def download(url, filename):
+    query = dict(parse_qsl(urlsplit(url).query))
+    queries.append(query)
+    cells = Api_EW._expand(query.get("CELL", "1...3"))
+    pd.DataFrame({"GEOGRAPHY_CODE": "E1", "CELL": cells, "OBS_VALUE": cells}).to_csv(str(filename), sep="\t", index=False)
+  monkeypatch.setenv("NOMIS_API_KEY", "test")
+  monkeypatch.setattr(Api_EW.transport, "download", download)
+  with open(str(tmp_path / "T_metadata.json"), "w") as fd:
+    json.dump({"nomis_table": "NM_1_1", "description": "", "fields": {"GEOGRAPHY": {}, "CELL": {"1": "a", "2": "b", "3": "c"}},
+               "geographies": {}}, fd)
+  api = Api_EW.Nomisweb(str(tmp_path))
+  api._Nomisweb__offline_mode = False
+  assert len(api.get_data("T", {"geography": "1"})) == 3
+  assert api.get_data("T", {"geography": "1", "CELL": "1,3"}).OBS_VALUE.tolist() == [1, 3]
+  assert len(queries) == 1
+
+# without pyarrow no binary copies are made, and incremental queries fall back to being cached per query
+def test_get_data_without_arrow(tmp_path, monkeypatch):
+  import json
+  import pandas as pd
+  from ukcensusapi import utils
+  from urllib.parse import urlsplit, parse_qsl
+  queries = []
+  def download(url, filename):
+    query = dict(parse_qsl(urlsplit(url).query))
+    queries.append(query)
+    geogs = Api_EW._expand(query["geography"])
+    pd.DataFrame({"GEOGRAPHY": geogs, "OBS_VALUE": geogs}).to_csv(str(filename), sep="\t", index=False)
+  monkeypatch.setenv("NOMIS_API_KEY", "test")
+  monkeypatch.setattr(Api_EW.transport, "download", download)
+  monkeypatch.setattr(utils, "feather", None)
+  with open(str(tmp_path / "T_metadata.json"), "w") as fd:
+    json.dump({"nomis_table": "NM_1_1", "description": "", "fields": {"GEOGRAPHY": {}}, "geographies": {}}, fd)
+  api = Api_EW.Nomisweb(str(tmp_path))
+  api._Nomisweb__offline_mode = False
+  for _ in range(2):
+    assert api.get_data("T", {"geography": "1...3"}, incremental=True).OBS_VALUE.tolist() == [1, 2, 3]
+  assert len(queries) == 1
+  assert not utils.write_columnar(pd.DataFrame({"a": [1]}), tmp_path / "x.tsv")
+  assert [f.suffix for f in tmp_path.iterdir() if f.suffix not in [".json", ".tsv", ".lock"]] == []
+
+# aggregated data returned to R is kept separate from the query's cached data
+def test_get_data_rollup_r_compat(tmp_path, monkeypatch):
+  import json
+  import pandas as pd
+  from urllib.parse import urlsplit, parse_qsl
+  queries = []
+  areas = {"TYPE298": ["L1", "L2", "L3"], "TYPE297": ["M1", "M2"]}
+  def download(url, filename):
+    query = dict(parse_qsl(urlsplit(url).query))
+    queries.append(query)
+    codes = areas[query["geography"][query["geography"].index("TYPE"):]]
+    pd.DataFrame({"GEOGRAPHY": range(len(codes)), "GEOGRAPHY_NAME": codes, "GEOGRAPHY_CODE": codes, "CELL": 1, "OBS_VALUE": 1}) \
+      .to_csv(str(filename), sep="\t", index=False)
+  monkeypatch.setenv("NOMIS_API_KEY", "test")
+  monkeypatch.setattr(Api_EW.transport, "download", download)
+  with open(str(tmp_path / "T_metadata.json"), "w") as fd:
+    json.dump({"nomis_table": "NM_1_1", "description": "", "fields": {"GEOGRAPHY": {}, "CELL": {}}, "geographies": {}}, fd)
+  pd.DataFrame({"OA11": ["O1", "O2", "O3"], "LSOA11": ["L1", "L2", "L3"], "MSOA11": ["M1", "M1", "M2"], "LAD": "A"}) \
+    .to_csv(str(tmp_path / "ew_lookup.csv"), index=False)
+  api = Api_EW.Nomisweb(str(tmp_path))
+  api._Nomisweb__offline_mode = False
+  query = {"geography": "1TYPE297", "CELL": "1", "MEASURES": "20100"}
+  api.get_data("T", dict(query, geography="1TYPE298"))
+
+  filename = api.get_data("T", query, r_compat=True, rollup=True)
+  assert filename.endswith("_rollup.tsv")
+  assert pd.read_csv(filename, delimiter="\t").OBS_VALUE.tolist() == [2, 1]
+  assert len(queries) == 1
+  # the query itself is still downloaded, as nomisweb returns it
+  data = api.get_data("T", query)
+  assert list(data.columns) == ["GEOGRAPHY", "GEOGRAPHY_NAME", "GEOGRAPHY_CODE", "CELL", "OBS_VALUE"]
+  assert len(queries) == 2
+
+# failed metadata requests are reported, and give empty metadata
+def test_get_metadata_errors(tmp_path, monkeypatch):
+  import requests
+  def get(url, **kwargs):
+    if "/CELL." in url:
+      raise requests.exceptions.ConnectionError("unreachable")
+    response = requests.Response()
+    response.status_code = 200
+    if "/geography/" in url:
+      response._content = b'{"structure": {"codelists": {}}}'
+    else:
+      response._content = b'{"structure": {"keyfamilies": {"keyfamily": [{"id": "NM_1_1", "name": {"value": "T"}, "components": {"dimension": [{"conceptref": "CELL"}]}}]}}}'
+    return response
+  monkeypatch.setenv("NOMIS_API_KEY", "test")
+  monkeypatch.setattr(Api_EW.transport, "get", get)
+  api = Api_EW.Nomisweb(str(tmp_path))
+  api._Nomisweb__offline_mode = False
+  assert api.get_metadata("T") == {}
+  assert Api_EW.Nomisweb(str(tmp_path), offline=True).get_metadata("T") == {}
+
+
+# the async API's concurrency limits every request, including the pieces of split queries
+def test_async_concurrency(tmp_path, monkeypatch):
+  import json
+  import time
+  import asyncio
+  import threading
+  import pandas as pd
+  from urllib.parse import urlsplit, parse_qsl
+  from ukcensusapi import AsyncNomisweb as Api_EW_async
+  lock = threading.Lock()
+  active = [0, 0]
+  def download(url, filename):
+    with lock:
+      active[0] += 1
+      active[1] = max(active)
+    time.sleep(0.01)
+    query = dict(parse_qsl(urlsplit(url).query))
+    pd.DataFrame({"GEOGRAPHY_CODE": Api_EW._expand(query["geography"]), "OBS_VALUE": 1}).to_csv(str(filename), sep="\t", index=False)
+    with lock:
+      active[0] -= 1
+  monkeypatch.setenv("NOMIS_API_KEY", "test")
+  monkeypatch.setattr(Api_EW.Nomisweb, "RowLimit", 2)
+  monkeypatch.setattr(Api_EW.transport, "download", download)
+  with open(str(tmp_path / "T_metadata.json"), "w") as fd:
+    json.dump({"nomis_table": "NM_1_1", "description": "", "fields": {"GEOGRAPHY": {}}, "geographies": {}}, fd)
+  async def run():
+    async with Api_EW_async.AsyncNomisweb(str(tmp_path), concurrency=3) as api:
+      api.api._Nomisweb__offline_mode = False
+      return await api.get_data_many([("T", {"geography": "%d...%d" % (i * 10 + 1, i * 10 + 10), "select": "GEOGRAPHY_CODE,OBS_VALUE"})
+                                      for i in range(8)])
+  results = asyncio.run(run())
+  assert [len(result) for result in results] == [10] * 8
+  assert active[1] <= 3
+
+
+# geography code lookups are cached (shortened) on first use, a corrupt cache is ignored, and saves merge with those
+# of other instances
+def test_geo_codes_cache(tmp_path, monkeypatch):
+  import json
+  import requests
+  requested = []
+  def get(url, **kwargs):
+    la_code = int(url.split("/geography/")[1].split("TYPE")[0])
+    requested.append(la_code)
+    response = requests.Response()
+    response.status_code = 200
+    codes = [{"value": la_code * 10 + i} for i in range(3)]
+    response._content = json.dumps({"structure": {"codelists": {"codelist": [{"code": codes}]}}}).encode()
+    return response
+  monkeypatch.setenv("NOMIS_API_KEY", "test")
+  monkeypatch.setattr(Api_EW.transport, "get", get)
+  (tmp_path / "lad_codes.json").write_text('{"A": 1, "B": 2, "C": 3}')
+  (tmp_path / "geo_codes.json").write_text('{"1:TYPE297": [1')
+  api1 = Api_EW.Nomisweb(str(tmp_path))
+  api2 = Api_EW.Nomisweb(str(tmp_path))
+  for api in [api1, api2]:
+    api._Nomisweb__offline_mode = False
+  assert api1.get_geo_codes(["1"], "TYPE297") == "10...12"
+  assert api2.get_geo_codes(["2", "1"], "TYPE297") == "10...12,20...22"
+  # (api2's cache is only loaded when first used, by which time api1 had saved its lookup)
+  assert requested == [1, 2]
+  assert json.loads((tmp_path / "geo_codes.json").read_text()) == {"1:TYPE297": "10...12", "2:TYPE297": "20...22"}
+  assert not list(tmp_path.glob("*.tmp"))
+  # lists of codes, as cached by earlier versions, are still read
+  (tmp_path / "geo_codes.json").write_text('{"3:TYPE297": [30, 31, 33]}')
+  assert Api_EW.Nomisweb(str(tmp_path)).get_geo_codes(["3"], "TYPE297") == "30...31,33"
+  assert requested == [1, 2]
+
+
+# checks cache entries are evicted in LRU order when over budget
+def test_cache_manifest(tmp_path):
+  manifest = cache.Manifest(tmp_path, budget=250)
+  for name in ["a", "b", "c"]:
+    (tmp_path / (name + ".tsv")).write_text("x" * 100)
+    manifest.add(tmp_path / (name + ".tsv"), "T", {"q": name})
+  # adding c evicts a (the least recently used)
+  assert sorted(f.name for f in tmp_path.glob("*.tsv")) == ["b.tsv", "c.tsv"]
+  assert manifest.total_size() == 200
+
+  manifest.touch(tmp_path / "b.tsv")
+  (tmp_path / "d.tsv").write_text("x" * 100)
+  manifest.add(tmp_path / "d.tsv", "T", {"q": "d"})
+  assert sorted(f.name for f in tmp_path.glob("*.tsv")) == ["b.tsv", "d.tsv"]
+
+  # reloads from disk
+  assert sorted(f.name for f in cache.Manifest(tmp_path).find("T")) == ["b.tsv", "d.tsv"]
+
+  # instances sharing the cache directory don't lose each other's entries, and the budget applies to them all
+  other = cache.Manifest(tmp_path, budget=250)
+  (tmp_path / "e.tsv").write_text("x" * 100)
+  other.add(tmp_path / "e.tsv", "T", {"q": "e"})
+  (tmp_path / "f.tsv").write_text("x" * 100)
+  manifest.add(tmp_path / "f.tsv", "T", {"q": "f"})
+  assert sorted(f.name for f in tmp_path.glob("*.tsv")) == ["e.tsv", "f.tsv"]
+  assert sorted(f.name for f in other.find("T")) == ["e.tsv", "f.tsv"]
+
+  # a cache hit doesn't rewrite the manifest, the access times are written in batches
+  import json
+  saved = (tmp_path / cache.Manifest.FILENAME).read_text()
+  other.touch(tmp_path / "f.tsv")
+  assert (tmp_path / cache.Manifest.FILENAME).read_text() == saved
+  other.flush()
+  assert json.loads((tmp_path / cache.Manifest.FILENAME).read_text())["f.tsv"]["accessed"] > json.loads(saved)["f.tsv"]["accessed"]
+
+
+# checks whether a query can be answered by filtering the cached result of another
+def test_superset_filters():
+  dims = {"GEOGRAPHY": None, "CELL": [1, 2, 3, 4, 5, 6], "MEASURES": [20100, 20301]}
+  cached = {"GEOGRAPHY": "1...10", "CELL": "1...5", "MEASURES": "20100", "DATE": "latest"}
+  assert Api_EW._superset_filters(dims, dict(cached), cached) == {}
+  assert Api_EW._superset_filters(dims, dict(cached, GEOGRAPHY="2,4...5", CELL="3"), cached) == {"GEOGRAPHY": [2, 4, 5], "CELL": [3]}
+  # not a subset of cells
+  assert Api_EW._superset_filters(dims, dict(cached, CELL="5...6"), cached) is None
+  # non-dimension parameter differs
+  assert Api_EW._superset_filters(dims, dict(cached, DATE="2001"), cached) is None
+  # selected columns must be a subset
+  assert Api_EW._superset_filters(dims, dict(cached, SELECT="CELL,OBS_VALUE"), cached) == {}
+  assert Api_EW._superset_filters(dims, dict(cached, SELECT="CELL"), dict(cached, SELECT="CELL,OBS_VALUE")) == {}
+  assert Api_EW._superset_filters(dims, dict(cached), dict(cached, SELECT="CELL,OBS_VALUE")) is None
+  # an omitted dimension means all its values
+  all_cells = {k: v for k, v in cached.items() if k != "CELL"}
+  assert Api_EW._superset_filters(dims, dict(cached, CELL="2,5"), all_cells) == {"CELL": [2, 5]}
+  assert Api_EW._superset_filters(dims, all_cells, dict(cached, CELL="1...6")) == {}
+  assert Api_EW._superset_filters(dims, all_cells, cached) is None
+  assert Api_EW._superset_filters(dims, dict(cached, CELL="7"), all_cells) is None
+  # (unless its values aren't known)
+  assert Api_EW._superset_filters(dims, cached, {k: v for k, v in cached.items() if k != "GEOGRAPHY"}) is None
+
+
+def test_hierarchy(tmp_path):
+  import pandas as pd
+  lookup = pd.DataFrame({"OA": ["o3", "o1", "o2", "o4"], "LSOA": ["l2", "l1", "l1", "l3"], "LAD": ["d1", "d1", "d1", "d2"]})
+  h = hierarchy.build(lookup, ["OA", "LSOA", "LAD"])
+  lookup_file = tmp_path / "lookup.csv"
+  lookup.to_csv(str(lookup_file), index=False)
+  h.save(lookup_file)
+  h = hierarchy.load(lookup_file)
+  assert list(h.areas("d1", "LAD", "OA")) == ["o3", "o1", "o2"]
+  assert list(h.areas(["d2", "dx", "d1"], "LAD", "LSOA")) == ["l2", "l1", "l3"]
+  assert list(h.areas(["o4", "o2"], "OA", "LAD")) == ["d1", "d2"]
+  data = pd.DataFrame({"GEOGRAPHY_CODE": ["l3", "l1", "l2", "l1"], "OBS_VALUE": [1, 2, 3, 4], "CAT": [0, 1, 1, 0]})
+  agg = h.aggregate(data, "LSOA", "LAD")
+  assert list(agg.columns) == ["GEOGRAPHY_CODE", "CAT", "OBS_VALUE"]
+  assert agg.values.tolist() == [["d1", 0, 4], ["d1", 1, 5], ["d2", 0, 1]]
+
+
+def test_transport_record_replay(tmp_path):
+  import gzip
+  import threading
+  import functools
+  import requests
+  from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+  from ukcensusapi import transport
+  (tmp_path / "www").mkdir()
+  (tmp_path / "www" / "data.json").write_text('{"a": 1}')
+  handler = functools.partial(SimpleHTTPRequestHandler, directory=str(tmp_path / "www"))
+  server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  url = "http://127.0.0.1:%d/data.json" % server.server_address[1]
+  try:
+    transport.configure(mode="record", store=tmp_path / "store")
+    assert transport.get(url + "?b=2&uid=secret&a=1").json() == {"a": 1}
+    transport.download(url, tmp_path / "recorded.json")
+  finally:
+    server.shutdown()
+    server.server_close()
+  try:
+    # the server is down, and the key and parameter order don't matter
+    transport.configure(mode="replay")
+    assert transport.get(url + "?a=1&b=2&uid=other").json() == {"a": 1}
+    with transport.get(url, stream=True) as response:
+      assert b"".join(response.iter_content(2)) == b'{"a": 1}'
+    transport.download(url, tmp_path / "replayed.json")
+    assert (tmp_path / "replayed.json").read_text() == '{"a": 1}'
+    with pytest.raises(requests.exceptions.ConnectionError):
+      transport.get(url + "?a=2")
+  finally:
+    transport.configure(mode="off")
+  # one recording per url (the download is recorded once, when complete)
+  assert len(list((tmp_path / "store").iterdir())) == 2
+  for filename in (tmp_path / "store").iterdir():
+    assert b"secret" not in gzip.decompress(filename.read_bytes())
+
+
+# interrupted, resumed, restarted and concurrent downloads
+def test_transport_download(tmp_path):
+  import gzip
+  import time
+  import zlib
+  import threading
+  import multiprocessing
+  from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+  from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+  from ukcensusapi import transport
+  content = bytes(range(256)) * 1000
+  ranges = []
+
+  class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+      offset = int(self.headers["Range"][6:-1]) if "Range" in self.headers and self.path != "/norange" else 0
+      ranges.append((self.path, offset))
+      # raw (not zlib-wrapped) deflate
+      if self.path == "/deflate":
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        body = compressor.compress(content) + compressor.flush()
+        self.send_response(200)
+        self.send_header("Content-Encoding", "deflate")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return
+      if offset >= len(content):
+        self.send_response(416)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        return
+      self.send_response(206 if offset else 200)
+      self.send_header("Content-Length", str(len(content) - offset))
+      self.end_headers()
+      # the first request for /truncate is cut short
+      if self.path == "/truncate" and len(ranges) == 1:
+        self.wfile.write(content[:1000])
+        return
+      # /slow is sent in pieces, so that concurrent downloads overlap
+      step = len(content) // 8 if self.path == "/slow" else len(content)
+      for start in range(offset, len(content), step):
+        self.wfile.write(content[start:start + step])
+        if self.path == "/slow":
+          time.sleep(0.02)
+
+    def log_message(self, *args):
+      pass
+
+  server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+  server.daemon_threads = True
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  url = "http://127.0.0.1:%d/" % server.server_address[1]
+  try:
+    # resumed from where the transfer stopped
+    transport.download(url + "truncate", tmp_path / "resumed")
+    assert (tmp_path / "resumed").read_bytes() == content
+    assert ranges == [("/truncate", 0), ("/truncate", 1000)]
+
+    # partial data that's too long (416), ignored range, and a different encoding all start again
+    for name, path, part, data in [("toolong", "data", "identity", content + b"x"),
+                                   ("ignored", "norange", "identity", content[:10]),
+                                   ("encoding", "data", "gzip", gzip.compress(content)[:10])]:
+      (tmp_path / ("%s.%s.part" % (name, part))).write_bytes(data)
+      transport.download(url + path, tmp_path / name)
+      assert (tmp_path / name).read_bytes() == content
+      assert not list(tmp_path.glob(name + ".*.part"))
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+      list(executor.map(lambda _: transport.download(url + "data", tmp_path / "concurrent"), range(16)))
+    assert (tmp_path / "concurrent").read_bytes() == content
+
+    # processes downloading the same file
+    with ProcessPoolExecutor(max_workers=3, mp_context=multiprocessing.get_context("spawn")) as executor:
+      list(executor.map(transport.download, [url + "slow"] * 3, [tmp_path / "processes"] * 3))
+    assert (tmp_path / "processes").read_bytes() == content
+
+    transport.download(url + "deflate", tmp_path / "deflated")
+    assert (tmp_path / "deflated").read_bytes() == content
+  finally:
+    server.shutdown()
+    server.server_close()
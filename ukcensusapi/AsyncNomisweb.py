@@ -0,0 +1,98 @@
+"""
+asyncio API for Nomisweb.
+"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import ukcensusapi.Nomisweb as ApiEW
+
+class AsyncNomisweb:
+  """
+  Asynchronous counterpart of the Nomisweb API, using the same cache directory (and layout).
+  Requests run on a bounded pool of worker threads sharing a single Nomisweb instance (and thus its pooled keep-alive
+  connections and caches), so coroutines never block the event loop. The number of concurrent requests to nomisweb is
+  limited by that instance, including those made on its own worker threads when a query is split into pieces.
+  """
+
+  # default maximum number of concurrent requests
+  Concurrency = 16
+
+  def __init__(self, cache_dir, verbose=False, cache_budget=None, concurrency=None, offline=False):
+    """Constructor.
+    Args:
+        cache_dir: cache directory
+        verbose: print diagnostic information
+        cache_budget: maximum size in bytes of cached data (see Nomisweb)
+        concurrency: maximum number of concurrent requests to nomisweb (default AsyncNomisweb.Concurrency)
+        offline: don't make any network requests, i.e. use pre-cached data only
+    Returns:
+        an instance.
+    """
+    concurrency = concurrency or AsyncNomisweb.Concurrency
+    self.api = ApiEW.Nomisweb(cache_dir, verbose=verbose, cache_budget=cache_budget, offline=offline, concurrency=concurrency)
+    self.cache_dir = self.api.cache_dir
+    self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *args):
+    self.close()
+
+  def close(self):
+    """
+    Shuts down the worker threads
+    """
+    self.executor.shutdown(wait=True)
+
+  async def get_data(self, table, query_params, r_compat=False, columns=None):
+    """Downloads or retrieves data given a table and query parameters. See Nomisweb.get_data
+    """
+    return await self.__run(self.api.get_data, table, dict(query_params), r_compat=r_compat, columns=columns)
+
+  async def get_data_many(self, requests, return_exceptions=False):
+    """Downloads or retrieves data for many queries concurrently (identical queries are only run once).
+    Args:
+       requests: a list of (table, query_params) tuples
+       return_exceptions: return exceptions in the results rather than raising the first one (as asyncio.gather)
+    Returns:
+        a list of dataframes, in the same order as the requests
+    """
+    unique = {}
+    for table, query_params in requests:
+      unique.setdefault((table, tuple(sorted(query_params.items()))), (table, query_params))
+    keys = list(unique)
+    results = await asyncio.gather(*[self.get_data(*unique[key]) for key in keys], return_exceptions=return_exceptions)
+    lookup = dict(zip(keys, results))
+    return [lookup[(table, tuple(sorted(query_params.items())))] for table, query_params in requests]
+
+  async def get_metadata(self, table_name):
+    """Downloads census table metadata. See Nomisweb.get_metadata
+    """
+    return await self.__run(self.api.get_metadata, table_name)
+
+  async def load_metadata(self, table_name):
+    """Retrieves cached, or downloads census table metadata. See Nomisweb.load_metadata
+    """
+    return await self.__run(self.api.load_metadata, table_name)
+
+  async def get_geo_codes(self, la_codes, code_type):
+    """Get nomis geographical codes. See Nomisweb.get_geo_codes
+    """
+    return await self.__run(self.api.get_geo_codes, la_codes, code_type)
+
+  def get_lad_codes(self, la_names):
+    """Convert local autority name(s) to nomisweb codes. See Nomisweb.get_lad_codes
+    """
+    return self.api.get_lad_codes(la_names)
+
+  def get_url(self, table_internal, query_params):
+    """Constructs a query url given a nomisweb table code and a query. See Nomisweb.get_url
+    """
+    return self.api.get_url(table_internal, query_params)
+
+  async def __run(self, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
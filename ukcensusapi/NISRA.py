@@ -3,13 +3,36 @@ Northern Ireland
 """
 
 import os.path
+import json
+import threading
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 import urllib.parse
 import zipfile
+import numpy as np
 import pandas as pd
-import requests
 
 import ukcensusapi.utils as utils
+import ukcensusapi.hierarchy as hierarchy
+import ukcensusapi.archives as archives
+
+def _read_data(stream, data_file):
+  """
+  Parses (wide format) table data and caches it
+  """
+  data = pd.read_csv(stream)
+  data["GeographyCode"] = data["GeographyCode"].astype(str)
+  utils.write_columnar(data, data_file)
+  return data
+
+def _cache_tables(archive, members, data_files):
+  """
+  Parses and caches table data from an archive (in a worker process, see NISRA.get_data_many)
+  """
+  with zipfile.ZipFile(archive) as z:
+    for member, data_file in zip(members, data_files):
+      with z.open(member) as stream:
+        _read_data(stream, data_file)
 
 # assumes all areas in coverage are the same type
 def _coverage_type(code):
@@ -86,31 +109,71 @@ class NISRA:
     "95ZZ":	"Strabane" 
   }
 
-    # initialise, supplying a location to cache downloads
-  def __init__(self, cache_dir):
+  # initialise, supplying a location to cache downloads
+  # nothing is downloaded (or checked online) until it's needed
+  def __init__(self, cache_dir, offline=False):
     """Constructor.
     Args:
         cache_dir: cache directory
+        offline: don't make any network requests, i.e. use pre-cached data only
     Returns:
         an instance.
     """
     # checks exists and is writable, creates if necessary
     self.cache_dir = utils.init_cache_dir(cache_dir)
 
-    self.offline_mode = not utils.check_online(self.URL)
-    if self.offline_mode:
-      print("Unable to contact %s, operating in offline mode - pre-cached data only" % self.URL)
+    # None means not yet determined
+    self.__offline_mode = True if offline else None
+    self.__area_lookup = None
+    self.__hierarchy = None
 
-    # download the lookup if not present
-    lookup_file = self.cache_dir / "ni_lookup.csv"
-    if not os.path.isfile(str(lookup_file)):
-      z = zipfile.ZipFile(str(self.__source_to_zip(NISRA.data_sources[2])))
-      pd.read_csv(z.open("All_Geographies_Code_Files/NI_HIERARCHY.csv")) \
-        .drop(["NUTS3","HSCT","ELB","COUNTRY"], axis=1) \
-        .to_csv(str(lookup_file), index=False)
+    # open archives and their member indices, and parsed metadata, keyed on (table, resolution)
+    self.__archives = {}
+    self.__archives_lock = threading.Lock()
+    self.__metadata = {}
 
-    # load the area lookup
-    self.area_lookup = pd.read_csv(str(lookup_file))
+  @property
+  def offline_mode(self):
+    """
+    True if the NISRA site is unreachable (checked on first use), or offline mode was requested at initialisation
+    """
+    if self.__offline_mode is None:
+      self.__offline_mode = not utils.check_online(self.URL)
+      if self.__offline_mode:
+        print("Unable to contact %s, operating in offline mode - pre-cached data only" % self.URL)
+    return self.__offline_mode
+
+  @property
+  def area_lookup(self):
+    """
+    The SA-SOA-WARD-LGD lookup, extracted if necessary and loaded on first use
+    """
+    if self.__area_lookup is None:
+      # download the lookup if not present
+      lookup_file = self.cache_dir / "ni_lookup.csv"
+      if not os.path.isfile(str(lookup_file)):
+        with self.__open_member(NISRA.data_sources[2], "All_Geographies_Code_Files/NI_HIERARCHY.csv") as member:
+          lookup = pd.read_csv(member)
+        lookup \
+          .drop(["NUTS3","HSCT","ELB","COUNTRY"], axis=1) \
+          .to_csv(str(lookup_file), index=False)
+
+      # load the area lookup
+      self.__area_lookup = pd.read_csv(str(lookup_file))
+    return self.__area_lookup
+
+  @property
+  def hierarchy(self):
+    """
+    The (integer-coded) SA-SOA-WARD-LGD hierarchy, compiled from the lookup if necessary and loaded on first use
+    """
+    if self.__hierarchy is None:
+      lookup_file = self.cache_dir / "ni_lookup.csv"
+      self.__hierarchy = hierarchy.load(lookup_file)
+      if self.__hierarchy is None:
+        self.__hierarchy = hierarchy.build(self.area_lookup, NISRA.NIGeoCodes[::-1])
+        self.__hierarchy.save(lookup_file)
+    return self.__hierarchy
 
   # TODO this is very close to duplicating the code in NRScotland.py - refactor?
   def get_geog(self, coverage, resolution):
@@ -123,13 +186,9 @@ class NISRA:
     # assumes all areas in coverage are the same type
     coverage_type = _coverage_type(coverage)
     if coverage_type == "ALL":
-      return self.area_lookup[resolution].unique()
-
-    # ensure list
-    if isinstance(coverage, str):
-      coverage = [coverage]
+      return self.hierarchy.codes[resolution]
 
-    return self.area_lookup[self.area_lookup[coverage_type].isin(coverage)][resolution].unique()
+    return self.hierarchy.areas(coverage, coverage_type, resolution)
 
   def get_metadata(self, table, resolution):
     return self.__get_metadata_impl(table, resolution)[0]
@@ -142,9 +201,34 @@ class NISRA:
     if resolution == "LGD" or resolution == "WARD":
       resolution = "SOA"
 
-    z = zipfile.ZipFile(str(self.__source_to_zip(NISRA.data_sources[NISRA.source_map[table[:2]]])))
-    raw_meta = pd.read_csv(z.open(NISRA.res_map[resolution]+"/"+table+"DESC0.CSV")) \
-                 .drop(["ColumnVariableMeasurementUnit", "ColumnVariableStatisticalUnit"], axis=1)
+    key = (table, resolution)
+    if key not in self.__metadata:
+      self.__metadata[key] = self.__load_metadata(table, resolution) or self.__parse_metadata(table, resolution)
+    return self.__metadata[key]
+
+  def __load_metadata(self, table, resolution):
+    """
+    Returns the cached (meta, raw_meta), or None if not cached
+    """
+    filename = self.cache_dir / ("%s_%s_metadata.json" % (table, resolution))
+    if not os.path.isfile(str(filename)):
+      return None
+    raw_meta = utils.read_columnar(filename)
+    if raw_meta is None:
+      return None
+    with open(str(filename)) as metafile:
+      meta = json.load(metafile)
+    # json keys are always strings
+    meta["fields"] = {field: {int(k): v for k, v in values.items()} for field, values in meta["fields"].items()}
+    return (meta, raw_meta.set_index("ColumnVariableCode", drop=True))
+
+  def __parse_metadata(self, table, resolution):
+    """
+    Parses the metadata from the archive and caches it
+    """
+    with self.__open_member(NISRA.data_sources[NISRA.source_map[table[:2]]], NISRA.res_map[resolution]+"/"+table+"DESC0.CSV") as member:
+      raw_meta = pd.read_csv(member) \
+                   .drop(["ColumnVariableMeasurementUnit", "ColumnVariableStatisticalUnit"], axis=1)
     # if every field has the same number of commas we split, otherwise assume number of categories
     # is the minimum. Warn that category names may be messed up 
     commas = raw_meta["ColumnVariableDescription"].str.count(",").unique()
@@ -177,8 +261,72 @@ class NISRA:
     # now remove text columns
     raw_meta.drop(text_columns, axis=1, inplace=True)
 
+    # cache the metadata, and then the (newer) binary copy of the raw metadata
+    filename = self.cache_dir / ("%s_%s_metadata.json" % (table, resolution))
+    with open(str(filename), "w") as metafile:
+      json.dump(meta, metafile, indent=2)
+    utils.write_columnar(raw_meta.reset_index(), filename)
+
     return (meta, raw_meta)
 
+  def __get_table(self, table, resolution, columns=None):
+    """
+    Gets the (wide format) data, from the cache if possible, otherwise parsing it from the archive and caching it.
+    Optionally only the specified columns are loaded
+    """
+    data_file = self.__data_file(table, resolution)
+    data = utils.read_columnar(data_file, columns)
+    if data is None:
+      with self.__open_member(NISRA.data_sources[NISRA.source_map[table[:2]]], self.__data_member(table, resolution)) as member:
+        data = _read_data(member, data_file)
+      if columns is not None:
+        data = data[columns]
+    return data
+
+  def __data_file(self, table, resolution):
+    return self.cache_dir / ("%s_%s.data" % (table, resolution))
+
+  def __data_member(self, table, resolution):
+    return NISRA.res_map[resolution] + "/" + table + "DATA0.CSV"
+
+  def get_data_many(self, tables, region, resolution, category_filters={}, max_workers=None):
+    """
+    Returns data for several tables (see get_data). Tables are grouped by source archive, and the data for any tables
+    not already cached is extracted and parsed in parallel, using a pool of processes, each opening the archive once.
+    Args:
+      tables: the table names
+      region, resolution, category_filters: as get_data (the category filters are applied to every table)
+      max_workers: the maximum number of processes (defaults to the number of CPUs)
+    Returns:
+      a dict of dataframes, keyed on table name
+    """
+    source_resolution = _ni_resolution(resolution)
+    if source_resolution == "LGD" or source_resolution == "WARD":
+      source_resolution = "SOA"
+
+    sources = {}
+    for table in dict.fromkeys(tables):
+      # the metadata is quick to parse
+      self.__get_metadata_impl(table, source_resolution)
+      if not utils.has_columnar(self.__data_file(table, source_resolution)):
+        sources.setdefault(NISRA.data_sources[NISRA.source_map[table[:2]]], []).append(table)
+
+    # (the parsed tables are passed back via the cache, as binary copies)
+    if sources and utils.columnar_available():
+      jobs = []
+      n = max_workers or os.cpu_count() or 1
+      for source_name, source_tables in sources.items():
+        archive = str(self.__source_to_zip(source_name))
+        for chunk in [source_tables[i::n] for i in range(min(n, len(source_tables)))]:
+          jobs.append((archive,
+                       [self.__data_member(table, source_resolution) for table in chunk],
+                       [str(self.__data_file(table, source_resolution)) for table in chunk]))
+      with ProcessPoolExecutor(max_workers=min(n, len(jobs))) as executor:
+        # raise any errors
+        list(executor.map(_cache_tables, *zip(*jobs)))
+
+    return {table: self.get_data(table, region, resolution, category_filters) for table in tables}
+
   def get_data(self, table, region, resolution, category_filters={}, r_compat=False):
 
     resolution = _ni_resolution(resolution)
@@ -194,34 +342,42 @@ class NISRA:
 
     area_codes = self.get_geog(region, resolution)
 
-    z = zipfile.ZipFile(str(self.__source_to_zip(NISRA.data_sources[NISRA.source_map[table[:2]]])))
+    # Filter by category before loading the data: each data column is a combination of category values,
+    # so only the columns matching the filters need to be read
+    category_filters = {category: [filter] if isinstance(filter, int) else filter for category, filter in category_filters.items()}
+    for category in [category for category in category_filters if category in raw_meta.columns]:
+      raw_meta = raw_meta[raw_meta[category].isin(category_filters.pop(category))]
+
     id_vars = ["GeographyCode"]
-    raw_data = pd.read_csv(z.open(NISRA.res_map[resolution]+"/"+table+"DATA0.CSV")) \
-                 .melt(id_vars=id_vars)
-    raw_data.columns = ["GEOGRAPHY_CODE", table, "OBS_VALUE"]
+    raw_data = self.__get_table(table, resolution, id_vars + raw_meta.index.tolist())
 
-    # Filter by region
-    raw_data = raw_data[raw_data["GEOGRAPHY_CODE"].isin(area_codes)]
+    # Filter by region before reshaping
+    raw_data = raw_data[raw_data["GeographyCode"].isin(area_codes)]
+    geography = raw_data["GeographyCode"].values
+    values = raw_data[raw_meta.index].values
 
-    # join with raw metadata and drop the combo code
-    data = raw_data.join(raw_meta, on=table).drop([table], axis=1)
+    # If we actually requested MSOA-level data, aggregrate the LSOAs within each MSOA (sorted by code)
+    if agg_workaround:
+      parents = self.hierarchy.parents(resolution, actual_resolution)[self.hierarchy.lookup(geography, resolution)]
+      geography, parents = np.unique(self.hierarchy.codes[actual_resolution][parents], return_inverse=True)
+      order = np.argsort(parents.ravel(), kind="stable")
+      starts = np.flatnonzero(np.diff(parents.ravel()[order], prepend=-1))
+      values = np.add.reduceat(values[order], starts, axis=0) if len(order) else values
+
+    # reshape to long format, taking the geography and category codes by (integer) position rather than joining
+    # on the (string) data column codes. Values are ordered by data column, then area
+    n_areas, n_columns = values.shape
+    data = pd.DataFrame({"GEOGRAPHY_CODE": np.tile(geography, n_columns), "OBS_VALUE": values.ravel(order="F")})
+    for category in raw_meta.columns:
+      data[category] = np.repeat(raw_meta[category].values, n_areas)
 
-    # If we actually requested MSOA-level data, aggregrate the LSOAs within each MSOA
     if agg_workaround:
-      data = data.reset_index(drop=True)
-      lookup = self.area_lookup[self.area_lookup[resolution].isin(data.GEOGRAPHY_CODE)]
-      lookup = pd.Series(lookup[actual_resolution].values, index=lookup[resolution]).to_dict()
-      data.GEOGRAPHY_CODE = data.GEOGRAPHY_CODE.map(lookup)
-      cols = list(data.columns)
-      # remove acts in-place and has no return value so can't chain it 
-      cols.remove("OBS_VALUE")
-      data = data.groupby(cols).sum().reset_index()
-
-    # Filter by category
-    for category in category_filters:
-      filter = category_filters[category]
-      if isinstance(filter, int):
-        filter = [filter]
+      # same ordering and column order as a groupby
+      data = data.iloc[np.lexsort([data[column].values for column in reversed(data.columns.drop("OBS_VALUE"))])]
+      data = data[list(data.columns.drop("OBS_VALUE")) + ["OBS_VALUE"]]
+
+    # Filter by anything else
+    for category, filter in category_filters.items():
       data = data[data[category].isin(filter)]
 
     # for R (which doesnt understand a pandas dataframe), we return np.arrays
@@ -245,23 +401,48 @@ class NISRA:
 
     return table
 
-  # TODO this could be merged with the Scottish version
+  def __open_member(self, source_name, member):
+    """
+    Opens a member of a source archive, which is (downloaded if necessary and) opened, and its members indexed, once only
+    """
+    with self.__archives_lock:
+      if source_name not in self.__archives:
+        archive = zipfile.ZipFile(str(self.__source_to_zip(source_name)))
+        self.__archives[source_name] = (archive, {info.filename: info for info in archive.infolist()})
+      archive, index = self.__archives[source_name]
+    if member not in index:
+      raise KeyError("There is no item named %r in %s" % (member, archive.filename))
+    return archive.open(index[member])
+
+  def sources(self):
+    """
+    Returns (url, filename, legacy_tls) for each of the source data archives (see archives.download)
+    """
+    return [self.__source(source_name) for source_name in NISRA.data_sources]
+
+  def prefetch(self, max_workers=None):
+    """
+    Downloads (if not already cached) all the source data archives, concurrently
+    Returns:
+      the archive filenames
+    """
+    return archives.download(self.sources(), max_workers=max_workers)
+
+  def __source(self, source_name):
+    """
+    Returns the url and local filename (replacing spaces with _) of the source data archive
+    """
+    # The URL must have %20 for space (only)
+    return (NISRA.URL + source_name.replace(" ", "%20"), self.cache_dir / source_name.replace(" ", "_"), False)
+
   def __source_to_zip(self, source_name):
     """
-    Downloads if necessary and returns the name of the locally cached zip file of the source data (replacing spaces with _)
+    Downloads if necessary and returns the name of the locally cached zip file of the source data
     """
-    zipfile = self.cache_dir / source_name.replace(" ", "_")
-    if not os.path.isfile(str(zipfile)):
-      # The URL must have %20 for space (only)
-      ni_src = NISRA.URL + source_name.replace(" ", "%20")
-      print(ni_src, " -> ", zipfile, "...", end="")
-      response = requests.get(ni_src)
-      response.raise_for_status()
-      with open(str(zipfile), 'wb') as fd:
-        for chunk in response.iter_content(chunk_size=1024):
-          fd.write(chunk)
-      print("OK")
-    return zipfile
+    ni_src, zipfile, legacy_tls = self.__source(source_name)
+    if not os.path.isfile(str(zipfile)) and self.offline_mode:
+      raise RuntimeError("%s is not in the cache and NISRA is offline" % zipfile)
+    return archives.fetch(ni_src, zipfile, legacy_tls)
 
 def _ni_resolution(resolution):
   """
@@ -3,36 +3,118 @@ Data scraper for Scottish 2011 census Data
 """
 
 import os.path
+import json
+import shutil
+import threading
+import contextlib
+import subprocess
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 import urllib.parse
-import zipfile
 import pandas as pd
-import requests
+
+try:
+  # a drop-in replacement for zipfile that can also decompress deflate64 (which some of the archives use)
+  import zipfile_deflate64 as zipfile
+except ImportError:
+  import zipfile
 
 import ukcensusapi.utils as utils
+import ukcensusapi.transport as transport
+import ukcensusapi.hierarchy as hierarchy
+import ukcensusapi.archives as archives
 
 # workaround for apparent bug in later versions of openssl (e.g. 1.1.1f on ubuntu focal)
 # that causes this issue: https://github.com/virgesmith/UKCensusAPI/issues/48
-def _ssl_get_workaround(url, headers):
-  import ssl
-  from urllib3 import poolmanager
-  import warnings
-  # suppress ResourceWarning: unclosed <ssl.SSLSocket...
-  warnings.filterwarnings(action='ignore', category=ResourceWarning, message="unclosed <ssl.SSLSocket.*>")
-  class TLSAdapter(requests.adapters.HTTPAdapter):
-    def init_poolmanager(self, connections, maxsize, block=False):
-      """Create and initialize the urllib3 PoolManager."""
-      ctx = ssl.create_default_context()
-      ctx.set_ciphers('DEFAULT@SECLEVEL=1')
-      self.poolmanager = poolmanager.PoolManager(
-        num_pools=connections,
-        maxsize=maxsize,
-        block=block,
-        ssl_version=ssl.PROTOCOL_TLS,
-        ssl_context=ctx)
-  session = requests.session()
-  session.mount('https://', TLSAdapter())
-  return session.get(url, headers=headers)
+def _ssl_get_workaround(url, headers=None):
+  return transport.get(url, legacy_tls=True, headers=headers, stream=True)
+
+# command line tools that can stream a (deflate64-compressed) zip archive member to stdout
+_EXTRACT_TOOLS = [["unzip", "-p"], ["7z", "e", "-so"], ["7za", "e", "-so"]]
+
+@contextlib.contextmanager
+def _open_member(archive, member):
+  """
+  Opens a member of a zip archive (a filename or an open ZipFile) for reading. Members compressed with deflate64, which
+  python's zipfile package can't decompress, are read using zipfile_deflate64 if installed, otherwise streamed from an
+  external unzip or 7z process
+  """
+  z = archive if isinstance(archive, zipfile.ZipFile) else zipfile.ZipFile(str(archive))
+  try:
+    try:
+      stream = z.open(member)
+    except NotImplementedError:
+      stream = None
+    if stream is not None:
+      with stream:
+        yield stream
+      return
+  finally:
+    if z is not archive:
+      z.close()
+
+  archive = z.filename
+  tool = next((tool for tool in _EXTRACT_TOOLS if shutil.which(tool[0])), None)
+  if tool is None:
+    raise RuntimeError("%s in %s is compressed using deflate64, which requires either the zipfile-deflate64 package "
+                       "(pip install zipfile-deflate64) or unzip or 7z to be installed" % (member, archive))
+  process = subprocess.Popen(tool + [str(archive), member], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  try:
+    yield process.stdout
+  finally:
+    process.stdout.close()
+    stderr = process.stderr.read().decode(errors="replace")
+    process.stderr.close()
+    returncode = process.wait()
+  if returncode != 0:
+    raise RuntimeError("%s failed to extract %s from %s: %s" % (tool[0], member, archive, stderr.strip()))
+
+def _cache_tables(cache_dir, tables, resolution):
+  """
+  Parses and caches tables (in a worker process, see NRScotland.extract_all and NRScotland.get_data_many)
+  Returns the names of the tables cached, omitting any with no data at this resolution
+  """
+  api = NRScotland(cache_dir, offline=True)
+  cached = []
+  for table in tables:
+    try:
+      api.get_metadata(table, resolution)
+      cached.append(table)
+    except ValueError:
+      pass
+  return cached
+
+def _chunks(items, n):
+  """
+  Splits items into (at most) n similarly-sized lists
+  """
+  return [items[i::n] for i in range(min(n, len(items)))]
+
+def _read_csv(source):
+  """
+  Reads raw table data, cleaning up the mess as it's parsed:
+  - some csv files contain numbers with comma thousands separators (!)
+  - rather than using 0 to represent zero, hyphen is used
+  The value columns are integers unless they contain fractional values.
+  Assumes the first column is geography, followed by any (unnamed) category columns, followed by the values
+  """
+  data = pd.read_csv(source, thousands=",", na_values=["-"])
+  columns = data.columns.tolist()
+  col_index = 1
+  while col_index < len(columns) and columns[col_index][:8] == "Unnamed:":
+    col_index = col_index + 1
+  for column in columns[col_index:]:
+    values = data[column].fillna(0)
+    if values.dtype == float and (values % 1 == 0).all():
+      values = values.astype("int64")
+    data[column] = values
+  return data
+
+def _id_columns(table, meta):
+  """
+  The geography and (other than the main) category columns, which aren't melted
+  """
+  return ["GEOGRAPHY_CODE"] + [table + "_" + str(i) + "_CODE" for i in range(1, len(meta["fields"]))]
 
 # Geographical area (EW equivalents)
 # Council area (LAD)
@@ -90,29 +172,69 @@ class NRScotland:
   SCGeoCodes = [ "CA", "DZ", "OA" ]
 
   # initialise, supplying a location to cache downloads
-  def __init__(self, cache_dir):
+  # nothing is downloaded (or checked online) until it's needed
+  def __init__(self, cache_dir, offline=False):
     """Constructor.
     Args:
         cache_dir: cache directory
+        offline: don't make any network requests, i.e. use pre-cached data only
     Returns:
         an instance.
     """
     # checks exists and is writable, creates if necessary
     self.cache_dir = utils.init_cache_dir(cache_dir)
 
-    self.offline_mode = not utils.check_online(self.URL1)
-    if self.offline_mode:
-     print("Unable to contact %s, operating in offline mode - pre-cached data only" % self.URL1)
-
-    # download the lookup if not present
-    lookup_file = self.cache_dir / "sc_lookup.csv"
-    if not os.path.isfile(str(lookup_file)):
-      self.make_sc_lookup()
+    # None means not yet determined
+    self.__offline_mode = True if offline else None
+    self.__area_lookup = None
+    self.__hierarchy = None
 
-    self.area_lookup = pd.read_csv(str(self.cache_dir / "sc_lookup.csv"))
+    # open archives, keyed on source name
+    self.__archives = {}
+    self.__archives_lock = threading.Lock()
 
-    # TODO use a map (just in case col order changes)
-    self.area_lookup.columns = ["OA11", "LSOA11", "MSOA11", "LAD"]
+  @property
+  def offline_mode(self):
+    """
+    True if the NRScotland site is unreachable (checked on first use), or offline mode was requested at initialisation
+    """
+    if self.__offline_mode is None:
+      self.__offline_mode = not utils.check_online(self.URL1)
+      if self.__offline_mode:
+        print("Unable to contact %s, operating in offline mode - pre-cached data only" % self.URL1)
+    return self.__offline_mode
+
+  @property
+  def area_lookup(self):
+    """
+    The OA-DZ-IZ-CA lookup, downloaded if necessary and loaded on first use
+    """
+    if self.__area_lookup is None:
+      # download the lookup if not present
+      lookup_file = self.cache_dir / "sc_lookup.csv"
+      if not os.path.isfile(str(lookup_file)):
+        if self.offline_mode:
+          raise RuntimeError("%s is not in the cache and NRScotland is offline" % lookup_file)
+        self.make_sc_lookup()
+
+      self.__area_lookup = pd.read_csv(str(lookup_file))
+
+      # TODO use a map (just in case col order changes)
+      self.__area_lookup.columns = ["OA11", "LSOA11", "MSOA11", "LAD"]
+    return self.__area_lookup
+
+  @property
+  def hierarchy(self):
+    """
+    The (integer-coded) OA-DZ-IZ-CA hierarchy, compiled from the lookup if necessary and loaded on first use
+    """
+    if self.__hierarchy is None:
+      lookup_file = self.cache_dir / "sc_lookup.csv"
+      self.__hierarchy = hierarchy.load(lookup_file)
+      if self.__hierarchy is None:
+        self.__hierarchy = hierarchy.build(self.area_lookup, ["OA11", "LSOA11", "MSOA11", "LAD"])
+        self.__hierarchy.save(lookup_file)
+    return self.__hierarchy
 
   def get_geog(self, coverage, resolution):
     """
@@ -121,19 +243,70 @@ class NRScotland:
     # assumes all areas in coverage are the same type
     coverage_type = _coverage_type(coverage)
     if coverage_type == "ALL":
-      return self.area_lookup[resolution].unique()
+      return self.hierarchy.codes[resolution]
 
-    # ensure list
-    if isinstance(coverage, str):
-      coverage = [coverage]
-
-    return self.area_lookup[self.area_lookup[coverage_type].isin(coverage)][resolution].unique()
+    return self.hierarchy.areas(coverage, coverage_type, resolution)
 
   def get_metadata(self, table, resolution):
     """
     Returns the table metadata
     """
-    return self.__get_rawdata(table, resolution)[0]
+    meta = self.__load_metadata(table, resolution)
+    if meta is None:
+      meta = self.__get_table(table, resolution)[0]
+    return meta
+
+  def __load_metadata(self, table, resolution):
+    """
+    Returns the cached metadata, or None if not cached
+    """
+    filename = self.cache_dir / ("%s_%s_metadata.json" % (table, resolution))
+    if not os.path.isfile(str(filename)):
+      return None
+    with open(str(filename)) as metafile:
+      meta = json.load(metafile)
+    # json keys are always strings
+    category_field = table + "_0_CODE"
+    meta["fields"][category_field] = {int(k): v for k, v in meta["fields"][category_field].items()}
+    return meta
+
+  def __get_table(self, table, resolution, columns=None):
+    """
+    Gets the metadata and the cleaned and typed data, parsing the raw csv data only if not already cached.
+    The data is in wide format: geography and category code columns, followed by a value column for each code
+    (as a string) of the table's main category (<table>_0_CODE). Optionally only the specified columns are loaded
+    """
+    data_file = self.cache_dir / ("%s_%s.data" % (table, resolution))
+    meta = self.__load_metadata(table, resolution)
+    if meta is not None:
+      data = utils.read_columnar(data_file, columns)
+      if data is not None:
+        return (meta, data)
+
+    # (the values are cleaned and typed as the csv is read, see _read_csv)
+    meta, raw_data = self.__get_rawdata(table, resolution)
+    # assumes the first n are (unnamed) columns we don't want to melt, geography coming first: n = geog + num categories - 1 (the one to melt)
+    lookup = raw_data.columns.tolist()[len(meta["fields"]):]
+
+    cols = _id_columns(table, meta)
+    cols.extend([str(i) for i in range(0,len(lookup))])
+    raw_data.columns = cols
+
+    # convert categories to numeric values
+    for i in range(1,len(meta["fields"])):
+      category_name = raw_data.columns[i]
+      category_values = meta["fields"][category_name]
+      # make sure metadata has same no. of categories
+      assert len(category_values) == len(raw_data[category_name].unique())
+      category_map = { k: v for v, k in enumerate(category_values)}
+      raw_data[category_name] = raw_data[category_name].map(category_map)
+
+    # cache the data (first, so it's never older than the metadata) and metadata
+    raw_data["GEOGRAPHY_CODE"] = raw_data["GEOGRAPHY_CODE"].astype(str)
+    if utils.write_columnar(raw_data, data_file):
+      with open(str(self.cache_dir / ("%s_%s_metadata.json" % (table, resolution))), "w") as metafile:
+        json.dump(meta, metafile, indent=2)
+    return (meta, raw_data if columns is None else raw_data[columns])
 
   def __get_rawdata(self, table, resolution):
     """
@@ -141,19 +314,11 @@ class NRScotland:
     """
 
     if not os.path.exists(os.path.join(str(self.cache_dir), table + ".csv")):
-      z = zipfile.ZipFile(str(self.__source_to_zip(NRScotland.data_sources[NRScotland.GeoCodeLookup[resolution]])))
-      #print(z.namelist())
-      try:
-        raw_data = pd.read_csv(z.open(table + ".csv"))
-      except NotImplementedError:
-        print("Problem: The census data uses a proprietary compression algorithm (probably deflate64) and cannot be extracted by the python zip package.")
-        print("Solution: manually extract this archive using a non-python extraction tool: %s" % z.filename)
-        print("e.g. use 7zip, or (on linux):\n\n$ unzip %s\n" % z.filename)
-        print("or, if you only need a specfic table:\n\n$ unzip %s -d %s %s\n" % (z.filename, self.cache_dir, table + ".csv"))
-        print("Please also consider politely asking NRScotland to change the compression algorithm!\n")
-        exit(1)
+      archive = self.__archive(NRScotland.data_sources[NRScotland.GeoCodeLookup[resolution]])
+      with _open_member(archive, table + ".csv") as stream:
+        raw_data = _read_csv(stream)
     else:
-      raw_data = pd.read_csv(os.path.join(str(self.cache_dir), table + ".csv"))
+      raw_data = _read_csv(os.path.join(str(self.cache_dir), table + ".csv"))
     # more sophisticate way to check for no data?
     if raw_data.shape == (2,1):
       raise ValueError("Table {}: data not available at {} resolution.".format(table, resolution))
@@ -197,60 +362,33 @@ class NRScotland:
       resolution = "LSOA11"
 
     geography = self.get_geog(coverage, resolution)
-    meta, raw_data = self.__get_rawdata(table, resolution)
-    # Clean up the mess:
-    # - some csv files contain numbers with comma thousands separators (!)
-    # - rather than using 0 to represent zero, hyphen is used
-    raw_data.replace("-", 0, inplace=True)
-    raw_data.replace(",", "", inplace=True, regex=True)
-    # assumes the first n are (unnamed) columns we don't want to melt, geography coming first: n = geog + num categories - 1 (the one to melt)
-    lookup = raw_data.columns.tolist()[len(meta["fields"]):]
-
-    id_vars = ["GEOGRAPHY_CODE"]
-    for i in range(1,len(meta["fields"])):
-      id_vars.append(table + "_" + str(i) + "_CODE")
-    cols = id_vars.copy()
-    cols.extend(list(range(0,len(lookup))))
-
-    raw_data.columns = cols
-    raw_data = raw_data.melt(id_vars=id_vars)
-    id_vars.extend([table + "_0_CODE", "OBS_VALUE"])
-    raw_data.columns = id_vars
-
-    # ensure OBS_VALUE is numeric
-    raw_data["OBS_VALUE"] = pd.to_numeric(raw_data["OBS_VALUE"])
-
-    # convert categories to numeric values
-    for i in range(1,len(meta["fields"])):
-      category_name = raw_data.columns[i]
-      category_values = meta["fields"][category_name]
-      # make sure metadata has same no. of categories
-      assert len(category_values) == len(raw_data[category_name].unique())
-      category_map = { k: v for v, k in enumerate(category_values)}
-      raw_data[category_name] = raw_data[category_name].map(category_map)
+    meta = self.get_metadata(table, resolution)
 
     # geography (and category_filter) must be lists
     if isinstance(geography, str):
       geography = [geography]
+    category_filters = {category: [filter] if isinstance(filter, int) else filter for category, filter in category_filters.items()}
 
-    # filter by geography
-    data = raw_data[raw_data.GEOGRAPHY_CODE.isin(geography)]
+    # filter (and only load) the columns and rows we need before reshaping:
+    # the main category's values are columns...
+    id_vars = _id_columns(table, meta)
+    value_column = table + "_0_CODE"
+    values = [str(code) for code in meta["fields"][value_column] if value_column not in category_filters or code in category_filters[value_column]]
+    data = self.__get_table(table, resolution, id_vars + values)[1]
+
+    # ...the other categories and geography are rows
+    rows = data.GEOGRAPHY_CODE.isin(geography)
+    for category, filter in category_filters.items():
+      if category != value_column:
+        rows &= data[category].isin(filter)
+    data = data[rows]
+
+    data = data.melt(id_vars=id_vars, var_name=value_column, value_name="OBS_VALUE")
+    data[value_column] = data[value_column].astype(int)
 
     # If we actually requested MSOA-level data, aggregrate the LSOAs within each MSOA
     if msoa_workaround:
-      data = data.reset_index(drop=True)
-      lookup = self.area_lookup[self.area_lookup.LSOA11.isin(data.GEOGRAPHY_CODE)]
-      lookup = pd.Series(lookup.MSOA11.values, index=lookup.LSOA11).to_dict()
-      data.GEOGRAPHY_CODE = data.GEOGRAPHY_CODE.map(lookup)
-      cols = list(data.columns[:-1]) #[1:]#.remove("GEOGRAPHY_CODE")
-      data = data.groupby(cols).sum().reset_index()
-
-    # multi-category filters
-    for category in category_filters:
-      filter = category_filters[category]
-      if isinstance(filter, int):
-        filter = [filter]
-      data = data[data[category].isin(filter)]
+      data = self.hierarchy.aggregate(data, "LSOA11", "MSOA11")
 
     data = data.reset_index(drop=True)
     if r_compat:
@@ -258,6 +396,70 @@ class NRScotland:
     else:
       return data
 
+  def extract_all(self, resolution, max_workers=None):
+    """
+    Extracts, parses and caches every table in the bulk data archive for resolution (downloading it if necessary),
+    using a pool of processes, so that subsequent get_data/get_metadata calls don't need to touch the archive.
+    Args:
+      resolution: the geographical resolution, e.g. "LSOA11"
+      max_workers: the number of processes (defaults to the number of CPUs)
+    Returns:
+      the names of the tables that were cached (tables with no data at this resolution are skipped)
+    """
+    if resolution == "MSOA11":
+      resolution = "LSOA11"
+    archive = self.__archive(NRScotland.data_sources[NRScotland.GeoCodeLookup[resolution]])
+    tables = [Path(name).stem for name in archive.namelist() if name.lower().endswith(".csv") and "/" not in name]
+    return self.__cache_tables(tables, resolution, max_workers)
+
+  def get_data_many(self, tables, coverage, resolution, category_filters={}, max_workers=None):
+    """
+    Returns data for several tables (see get_data). Any tables not already cached are extracted from the archive and
+    parsed in parallel, using a pool of processes.
+    Args:
+      tables: the table names
+      coverage, resolution, category_filters: as get_data (the category filters are applied to every table)
+      max_workers: the maximum number of processes (defaults to the number of CPUs)
+    Returns:
+      a dict of dataframes, keyed on table name
+    """
+    # MSOA data is aggregated from LSOA data
+    source_resolution = "LSOA11" if resolution == "MSOA11" else resolution
+    uncached = [table for table in dict.fromkeys(tables) if not self.__is_cached(table, source_resolution)]
+    if uncached:
+      self.__cache_tables(uncached, source_resolution, max_workers)
+    return {table: self.get_data(table, coverage, resolution, category_filters) for table in tables}
+
+  def __is_cached(self, table, resolution):
+    """
+    Returns True if the parsed table is cached
+    """
+    return os.path.isfile(str(self.cache_dir / ("%s_%s_metadata.json" % (table, resolution)))) \
+      and utils.has_columnar(self.cache_dir / ("%s_%s.data" % (table, resolution)))
+
+  def __cache_tables(self, tables, resolution, max_workers):
+    """
+    Parses and caches tables from the same archive, in parallel
+    """
+    # (the parsed tables are only cached as binary copies)
+    if not tables or not utils.columnar_available():
+      return []
+    # make sure the archive has been downloaded before starting the workers
+    self.__archive(NRScotland.data_sources[NRScotland.GeoCodeLookup[resolution]])
+    chunks = _chunks(tables, max_workers or os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+      cached = executor.map(_cache_tables, [str(self.cache_dir)] * len(chunks), chunks, [resolution] * len(chunks))
+      return [table for chunk in cached for table in chunk]
+
+  def __archive(self, source_name):
+    """
+    Returns the (open) archive of the source data, downloading it if necessary
+    """
+    with self.__archives_lock:
+      if source_name not in self.__archives:
+        self.__archives[source_name] = zipfile.ZipFile(str(self.__source_to_zip(source_name)))
+      return self.__archives[source_name]
+
   # TODO this is very close to duplicating the code in Nomisweb.py - refactor
   def contextify(self, table, meta, colname):
     """
@@ -272,24 +474,39 @@ class NRScotland:
 
     return table
 
-  def __source_to_zip(self, source_name):
+  def sources(self):
     """
-    Downloads if necessary and returns the name of the locally cached zip file of the source data (replacing spaces with _)
+    Returns (url, filename, legacy_tls) for each of the source data archives (see archives.download)
+    """
+    return [self.__source(source_name) for source_name in NRScotland.data_sources]
+
+  def prefetch(self, max_workers=None):
+    """
+    Downloads (if not already cached) all the source data archives, concurrently
+    Returns:
+      the archive filenames
+    """
+    return archives.download(self.sources(), max_workers=max_workers)
+
+  def __source(self, source_name):
+    """
+    Returns the url and local filename (replacing spaces with _) of the source data archive
     """
     zip = self.cache_dir / (source_name.replace(" ", "_") + ".zip")
-    headers = {'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:92.0) Gecko/20100101 Firefox/92.0'}
-    if not os.path.isfile(str(zip)):
-      if source_name.split()[0] == 'Council':
-        scotland_src = NRScotland.URL1 + "media/hjmd0oqr/" + source_name.lower().replace(" ", "-") + ".zip"
-      else:
-        scotland_src = NRScotland.URL2 + urllib.parse.quote(source_name) + ".zip"
-      response = requests.get(scotland_src, headers=headers)
-      response.raise_for_status()
-      with open(str(zip), 'wb') as fd:
-        for chunk in response.iter_content(chunk_size=1024):
-          fd.write(chunk)
-      print("OK")
-    return zip
+    if source_name.split()[0] == 'Council':
+      scotland_src = NRScotland.URL1 + "media/hjmd0oqr/" + source_name.lower().replace(" ", "-") + ".zip"
+    else:
+      scotland_src = NRScotland.URL2 + urllib.parse.quote(source_name) + ".zip"
+    return (scotland_src, zip, False)
+
+  def __source_to_zip(self, source_name):
+    """
+    Downloads if necessary and returns the name of the locally cached zip file of the source data
+    """
+    scotland_src, zip, legacy_tls = self.__source(source_name)
+    if not os.path.isfile(str(zip)) and self.offline_mode:
+      raise RuntimeError("%s is not in the cache and NRScotland is offline" % zip)
+    return archives.fetch(scotland_src, zip, legacy_tls)
 
   def make_sc_lookup(self):
     """
@@ -306,20 +523,19 @@ class NRScotland:
     """
     oa_lad_url = 'https://www.nrscotland.gov.uk/files/geography/2011-census/geog-2011-cen-supp-info-oldoa-newoa-lookup.xls'
     oa_dz_iz_url = 'https://www.nrscotland.gov.uk/files//geography/2011-census/OA_DZ_IZ_2011.xlsx'
-    headers = {'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:92.0) Gecko/20100101 Firefox/92.0'}
 
     # Grab and write files from NRSctoland website using ssl workaround
-    # Included headers because sites give a 403 error without them
-    response = _ssl_get_workaround(oa_lad_url, headers=headers)
+    # (the shared transport supplies the headers the sites require to avoid a 403 error)
+    response = _ssl_get_workaround(oa_lad_url)
     print(response.status_code)
     with open(str(self.cache_dir / 'oldoa-newoa-lookup.xls'), 'wb') as fd:
-      for chunk in response.iter_content(chunk_size=1024):
+      for chunk in response.iter_content(chunk_size=1024*1024):
         fd.write(chunk)
 
-    response = _ssl_get_workaround(oa_dz_iz_url, headers=headers)
+    response = _ssl_get_workaround(oa_dz_iz_url)
     print(response.status_code)
     with open(str(self.cache_dir / 'OA_DZ_IZ_2011.xlsx'), 'wb') as fd:
-      for chunk in response.iter_content(chunk_size=1024):
+      for chunk in response.iter_content(chunk_size=1024*1024):
         fd.write(chunk)
 
     # Read in the files, drop columns we don't need and merge on the Output Area codes
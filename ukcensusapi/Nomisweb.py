@@ -4,19 +4,22 @@ Nomisweb API.
 
 import os
 import json
+import math
 import hashlib
 import warnings
+import threading
+import contextlib
 from pathlib import Path
 from collections import OrderedDict
-from urllib import request
-from urllib.error import HTTPError
-from urllib.error import URLError
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlencode
-from socket import timeout
+import requests
 import pandas as pd
 #import numpy as np
 
 import ukcensusapi.utils as utils
+import ukcensusapi.transport as transport
+import ukcensusapi.cache as cache
 
 def _get_api_key(cache_dir):
   """
@@ -59,8 +62,109 @@ def _shorten(code_list):
     short_string += str(code_list[index0]) + "..." + str(code_list[index1])
   return short_string
 
+def _expand(short_string):
+  """
+  The inverse of _shorten, expands a string of numeric nomis geo codes into a (sorted) list, e.g.
+  "1...3,6,7...10" -> [1,2,3,6,7,8,9,10]
+  Raises ValueError if the string contains anything other than numeric codes and ranges (e.g. "2092957703TYPE464")
+  """
+  code_list = []
+  for item in str(short_string).split(","):
+    if not item:
+      continue
+    if "..." in item:
+      start, end = item.split("...")
+      code_list.extend(range(int(start), int(end) + 1))
+    else:
+      code_list.append(int(item))
+  code_list.sort()
+  return code_list
+
+def _split_codes(short_string, pieces):
+  """
+  Splits a shortened string of numeric nomis geo codes into (at most) the requested number of shortened strings
+  each containing (roughly) the same number of codes
+  """
+  code_list = _expand(short_string)
+  size = math.ceil(len(code_list) / max(pieces, 1))
+  return [_shorten(code_list[i:i+size]) for i in range(0, len(code_list), size)]
+
+def _count_values(value):
+  """
+  Returns the number of distinct values in a query parameter, e.g. "7...13" -> 7, "0" -> 1, or None if it can't be determined
+  """
+  try:
+    return len(_expand(value))
+  except ValueError:
+    return None
+
 
 
+def _selected_columns(params):
+  """
+  Returns the list of columns in the select parameter of a query (with upper-case keys), or None if there isn't one
+  """
+  if "SELECT" not in params:
+    return None
+  return [column.strip() for column in params["SELECT"].split(",") if column.strip()]
+
+def _superset_filters(dimensions, params, cached_params):
+  """
+  Determines whether a query (params) can be answered from the result of another (cached_params), both with upper-case keys.
+  This is the case when the cached query selects a superset of the columns, and for each dimension (including geography)
+  a superset of the values; all other parameters must be identical. A dimension that isn't in a query means all its
+  values, which can only be compared if they are known.
+  Args:
+    dimensions: {dimension: all its values (from the metadata), or None if not known (e.g. geography)}
+    params: the query
+    cached_params: the query of the cached data
+  Returns a dict of column: values filters to apply to the cached data, or None if the cached data isn't a superset
+  """
+  filters = {}
+  for key in set(params) | set(cached_params):
+    if key == "UID":
+      continue
+    if key == "SELECT":
+      # no select means all columns, which is a superset of any selection
+      if key in cached_params and (key not in params or \
+                                   not set(_selected_columns(params)).issubset(_selected_columns(cached_params))):
+        return None
+    elif key not in params or key not in cached_params:
+      if not dimensions.get(key):
+        return None
+      try:
+        # all values are requested, so all must be cached
+        if key not in params:
+          if not set(dimensions[key]).issubset(_expand(cached_params[key])):
+            return None
+          continue
+        values = _expand(params[key])
+      except ValueError:
+        return None
+      if not set(values).issubset(dimensions[key]):
+        return None
+      filters[key] = values
+    elif params[key] != cached_params[key]:
+      if key not in dimensions:
+        return None
+      try:
+        values = _expand(params[key])
+        if not set(values).issubset(_expand(cached_params[key])):
+          return None
+      except ValueError:
+        return None
+      filters[key] = values
+  return filters
+
+def _dimension_values(values):
+  """
+  The (integer) values of a dimension from the metadata, or None if they aren't known
+  """
+  try:
+    return [int(value) for value in values] or None
+  except ValueError:
+    return None
+
 # The core functionality for accessing the www.nomisweb.co.uk API
 class Nomisweb:
   """
@@ -73,6 +177,19 @@ class Nomisweb:
   # timeout for http requests
   Timeout = 15
 
+  # nomisweb truncates the result of any single data query at this many rows
+  RowLimit = 1000000
+
+  # maximum number of concurrent requests to nomisweb
+  MaxWorkers = 8
+
+  # E&W statistical geographies, finest first, that can be aggregated using the geography lookup
+  Hierarchy = ["OA11", "LSOA11", "MSOA11", "LAD"]
+
+  # columns that are specific to an individual area or observation and thus can't be aggregated
+  NonAdditiveColumns = ["GEOGRAPHY", "GEOGRAPHY_NAME", "GEOGRAPHY_TYPE", "GEOGRAPHY_TYPECODE", "GEOGRAPHY_SORTORDER",
+                        "OBS_STATUS", "OBS_STATUS_NAME", "OBS_CONF", "OBS_CONF_NAME", "URN", "RECORD_OFFSET", "RECORD_COUNT"]
+
   # # Define Nomisweb geographic area codes, see e.g.
   # https://www.nomisweb.co.uk/api/v01/dataset/NM_144_1/geography/2092957703TYPE464.def.sdmx.json
   # https://www.nomisweb.co.uk/api/v01/dataset/NM_1_1/geography/2092957703TYPE464.def.sdmx.json
@@ -92,39 +209,73 @@ class Nomisweb:
   }
 
   # initialise, supplying a location to cache downloads
-  def __init__(self, cache_dir, verbose=False):
+  # nothing is downloaded (or checked online) until it's needed
+  def __init__(self, cache_dir, verbose=False, cache_budget=None, offline=False, concurrency=None):
     """Constructor.
     Args:
         cache_dir: cache directory
+        verbose: print diagnostic information
+        cache_budget: maximum size in bytes of cached data, beyond which the least recently used data is evicted (default unlimited)
+        offline: don't make any network requests, i.e. use pre-cached data only
+        concurrency: maximum number of requests to nomisweb in progress at once, across all threads using this instance
+          (default unlimited, i.e. up to MaxWorkers per query, or per piece of a split query)
     Returns:
         an instance.
     """
     self.cache_dir = utils.init_cache_dir(cache_dir)
     self.verbose = verbose
-    self.offline_mode = True
 
-    # how best to deal with site unavailable...  
-    self.offline_mode = not utils.check_online(self.URL, Nomisweb.Timeout)
-    if self.offline_mode:
-      print("Unable to contact %s, operating in offline mode - pre-cached data only" % self.URL)
+    # None means not yet determined
+    self.__offline_mode = True if offline else None
+    self.__online_lock = threading.Lock()
+    self.__lad_codes_lock = threading.Lock()
+    self.__incremental_lock = threading.Lock()
+    self.__cached_lad_codes = None
+    self.__ew_lookup = None
+    # held for the duration of each request, so the pieces of split (or paged) queries share the limit
+    self.__requests = threading.BoundedSemaphore(concurrency) if concurrency else contextlib.nullcontext()
 
     self.key = _get_api_key(self.cache_dir)
-    if not self.offline_mode and self.key is None:
-      raise RuntimeError("No API key found. Whilst downloads still work, they may be truncated,\n" \
-                         "causing potentially unforseen problems in any modelling/analysis.\n" \
-                         "Set the key value in the environment variable NOMIS_API_KEY.\n" \
-                         "Register at www.nomisweb.co.uk to obtain a key")
 
     if self.verbose: print("Cache directory: ", self.cache_dir)
 
-    # static member
-    Nomisweb.cached_lad_codes = self.__cache_lad_codes()
+    # persistent cache of geography code lookups (in shortened form), keyed on area code and resolution type,
+    # loaded on first use
+    self.__geo_codes = None
+    self.__geo_codes_dirty = False
+    self.__geo_codes_lock = threading.Lock()
+
+    # manifest of cached data, used for eviction
+    self.manifest = cache.Manifest(self.cache_dir, cache_budget)
+    if cache_budget is not None:
+      self.manifest.evict()
+
+  @property
+  def offline_mode(self):
+    """
+    True if nomisweb is unreachable (checked on first use), or offline mode was requested at initialisation
+    """
+    with self.__online_lock:
+      if self.__offline_mode is None:
+        # how best to deal with site unavailable...
+        self.__offline_mode = not utils.check_online(self.URL, Nomisweb.Timeout)
+        if self.__offline_mode:
+          print("Unable to contact %s, operating in offline mode - pre-cached data only" % self.URL)
+      # (a replayed session doesn't need a key, see transport.configure)
+      if not self.__offline_mode and self.key is None and transport.MODE != "replay":
+        raise RuntimeError("No API key found. Whilst downloads still work, they may be truncated,\n" \
+                           "causing potentially unforseen problems in any modelling/analysis.\n" \
+                           "Set the key value in the environment variable NOMIS_API_KEY.\n" \
+                           "Register at www.nomisweb.co.uk to obtain a key")
+      return self.__offline_mode
 
   def get_geo_codes(self, la_codes, code_type):
     """Get nomis geographical codes.
+    The lookups for each local authority are run concurrently, and coverage of every LAD in England & Wales is
+    resolved with a single request for the parent geography.
 
     Args:
-        la_codes: local authority codes for the region
+        la_codes: local authority codes for the region (or country codes/names from GeoCodeLookup, e.g. "EnglandWales")
         code_type: enumeration specifying the geographical resolution
     Returns:
         a string representation of the codes.
@@ -133,21 +284,25 @@ class Nomisweb:
     if not isinstance(la_codes, list):
       la_codes = [la_codes]
 
-    geo_codes = []
-    for i in range(0, len(la_codes)):
-      path = "api/v01/dataset/NM_144_1/geography/" + str(la_codes[i]) + code_type + ".def.sdmx.json?"
-      rawdata = self.__fetch_json(path, {})
+    la_codes = self.__coverage_codes(la_codes)
 
-      # use try-catch block to deal with any issues arising from the returned json
-      # which are likely due to invalid/empty LA codes
-      try:
-        n_results = len(rawdata["structure"]["codelists"]["codelist"][0]["code"])
-        # seems a bit daft not to take advantage of the fact we know the length
-        for j in range(0, n_results):
-          geo_codes.append(rawdata["structure"]["codelists"]["codelist"][0]["code"][j]["value"])
-      except (KeyError, ValueError):
-        print(la_codes[i], " does not appear to be a valid LA code")
-    return _shorten(geo_codes)
+    # only spin up workers for lookups that aren't cached
+    cached_geo_codes = self.__cached_geo_codes()
+    uncached = [la_code for la_code in la_codes if la_code + ":" + code_type not in cached_geo_codes]
+    fetched = {}
+    if len(uncached) > 1:
+      with ThreadPoolExecutor(max_workers=Nomisweb.MaxWorkers) as executor:
+        fetched = dict(zip(uncached, executor.map(lambda la_code: self.__fetch_geo_codes(la_code, code_type), uncached)))
+    results = [fetched[la_code] if la_code in fetched else self.__fetch_geo_codes(la_code, code_type) for la_code in la_codes]
+
+    self.__save_geo_codes()
+
+    if len(results) == 1:
+      return results[0]
+    geo_codes = set()
+    for result in results:
+      geo_codes.update(_expand(result))
+    return _shorten(list(geo_codes))
 
   def get_lad_codes(self, la_names):
     """Convert local autority name(s) to nomisweb codes.
@@ -158,10 +313,11 @@ class Nomisweb:
     """
     if not isinstance(la_names, list):
       la_names = [la_names]
+    lad_codes = self.__lad_codes()
     codes = []
     for la_name in la_names:
-      if la_name in Nomisweb.cached_lad_codes:
-        codes.append(Nomisweb.cached_lad_codes[la_name])
+      if la_name in lad_codes:
+        codes.append(lad_codes[la_name])
     return codes
 
   def get_url(self, table_internal, query_params):
@@ -187,12 +343,19 @@ class Nomisweb:
   # Two reasons for this:
   # - pandas/R dataframes conversion is done via matrix (which drops col names)
   # - reporting errors to R is useful (print statements aren't displayed in R(Studio))
-  def get_data(self, table, query_params, r_compat=False):
+  def get_data(self, table, query_params, r_compat=False, columns=None, incremental=False, rollup=False):
     """Downloads or retrieves data given a table and query parameters.
+    Queries that would exceed nomisweb's row limit are split into smaller queries (each of which is cached separately),
+    downloaded concurrently and recombined.
     Args:
-       table: ONS table name, or nomisweb table code if no explicit ONS name 
+       table: ONS table name, or nomisweb table code if no explicit ONS name
        query_params: table query parameters
-       r_compat: return values suitable for R 
+       r_compat: return values suitable for R
+       columns: optionally, a subset of columns to return
+       incremental: cache the data per geography, so that only geographies not already cached are downloaded
+         (only applies when the geography is a list of area codes, and not to r_compat)
+       rollup: if possible, aggregate cached data at a finer resolution rather than downloading
+         (requires the E&W geography lookup, see make_ew_lookup)
     Returns:
         a dataframe containing the data. If downloaded, the data is also cached to a file
     """
@@ -200,19 +363,51 @@ class Nomisweb:
     # load the metadata
     metadata = self.load_metadata(table)
 
-    query_params["uid"] = self.key
-    query_string = self.get_url(metadata["nomis_table"], query_params)
-    filename = self.cache_dir / (table + "_" + hashlib.md5(query_string.encode()).hexdigest()+".tsv")
+    # the cache filename doesn't depend on the API key, so cached data can be shared
+    query = {k: v for k, v in query_params.items() if k != "uid"}
+    filename = self.__cache_filename(table, metadata["nomis_table"], query)
+    query_string = self.get_url(metadata["nomis_table"], dict(query, uid=self.key))
 
+    if incremental and not r_compat:
+      data = self.__get_data_incremental(table, metadata, query, columns)
+      if data is not None:
+        return data
+
+    data = None
     # retrieve if not in cache
     if not os.path.isfile(str(filename)):
-      if self.verbose: print("Downloading and cacheing data: " + str(filename))
-      #'TODO migrate to requests package
-      request.urlretrieve(query_string, str(filename)) #, timeout = Nomisweb.Timeout)
+      # see if the query can be answered by filtering data that's already cached
+      data = self.__get_data_from_superset(table, metadata, query)
+      # or by aggregating cached data at a finer resolution
+      if data is None and rollup:
+        data = self.__get_data_rollup(table, metadata, query)
+        # aggregated data doesn't have all the columns nomisweb would return, so it mustn't be cached as the query's data
+        if data is not None and r_compat:
+          filename = filename.with_name(filename.stem + "_rollup.tsv")
+      if data is not None:
+        if not r_compat:
+          return data if columns is None else data[columns]
+        self.__write_tsv(data, filename)
+      else:
+        # if we can tell in advance the query will be truncated, split it up front
+        pieces = self.__predict_pieces(metadata, query)
+        if pieces > 1:
+          if self.verbose: print("Query is predicted to exceed the row limit, splitting into %d pieces" % pieces)
+          data = self.__get_data_split(table, query, pieces)
+          if data is not None:
+            self.__write_tsv(data, filename)
+            utils.write_columnar(data, filename)
+        elif not self.offline_mode:
+          if self.verbose: print("Downloading and cacheing data: " + str(filename))
+          with self.__requests:
+            transport.download(query_string, filename)
+        elif self.verbose:
+          print("Operating in offline mode, unable to download " + str(filename))
 
       # check for empty file, if so delete it and report error
-      if os.stat(str(filename)).st_size == 0:
-        os.remove(str(filename))
+      if not os.path.isfile(str(filename)) or os.stat(str(filename)).st_size == 0:
+        if os.path.isfile(str(filename)):
+          os.remove(str(filename))
         errormsg = "ERROR: Query returned no data. Check table and query parameters"
         if r_compat:
           return errormsg
@@ -221,12 +416,33 @@ class Nomisweb:
     else:
       if self.verbose: print("Using cached data: " + str(filename))
 
-    # now load from cache and return
+    # R needs the tsv, which is always present
     if r_compat:
+      self.__update_manifest(filename, table, query)
       return str(filename) # R expects a string not a Path
-    data = pd.read_csv(str(filename), delimiter='\t')
-    if len(data) == 1000000:
-      warnings.warn("Data download has reached nomisweb's single-query row limit. Truncation is extremely likely")
+
+    # use the (much quicker to load) columnar copy of the data if there is one
+    if data is None:
+      data = utils.read_columnar(filename, columns)
+
+    if data is None:
+      data = pd.read_csv(str(filename), delimiter='\t')
+      # result has been truncated, split the query and replace the cached data with the complete result
+      # (unless this is already a page of a split query)
+      if len(data) == Nomisweb.RowLimit and "RecordOffset" not in query:
+        if self.verbose: print("Data download has reached nomisweb's single-query row limit, splitting query")
+        split_data = self.__get_data_split(table, query, 2, first_page=data)
+        if split_data is None:
+          warnings.warn("Data download has reached nomisweb's single-query row limit. Truncation is extremely likely")
+        else:
+          data = split_data
+          self.__write_tsv(data, filename)
+      utils.write_columnar(data, filename)
+
+    self.__update_manifest(filename, table, query)
+
+    if columns is not None and list(data.columns) != list(columns):
+      data = data[columns]
     return data
 
   def get_metadata(self, table_name):
@@ -247,6 +463,10 @@ class Nomisweb:
       query_params = {}
       
     data = self.__fetch_json(path, query_params)
+    # (__fetch_json reports the error and returns an empty reply if the request fails)
+    if not data:
+      print("HTTP error requesting metadata for " + table_name)
+      return {}
 
     # return empty if no useful metadata returned (likely table doesnt exist)
     if not data["structure"]["keyfamilies"]:
@@ -258,46 +478,33 @@ class Nomisweb:
     rawfields = data["structure"]["keyfamilies"]["keyfamily"][0]["components"]["dimension"]
     fields = {}
     for rawfield in rawfields:
-      field = rawfield["conceptref"]
-
-      fields[field] = {}
-
-      # ignore when too many categories (i.e. geograpical ones)
-      if field.upper() == "CURRENTLY_RESIDING_IN" or field.upper() == "PLACE_OF_WORK":
-        continue
-
-      # further query to get categories
-      path = "api/v01/dataset/"+table+"/"+field+".def.sdmx.json?"
-      #print(path)
-
-      try:
-        fdata = self.__fetch_json(path, {})
-      except timeout:
-        print("HTTP timeout requesting metadata for " + table_name)
-        return {}
-      except (HTTPError, URLError):
-        print("HTTP error requesting metadata for " + table_name)
-        return {}
-      else:
+      fields[rawfield["conceptref"]] = {}
+
+    # ignore when too many categories (i.e. geograpical ones)
+    category_fields = [field for field in fields if field.upper() not in ["CURRENTLY_RESIDING_IN", "PLACE_OF_WORK"]]
+
+    # further queries to get categories for each field, and the geographies available for this table, all run concurrently
+    with ThreadPoolExecutor(max_workers=Nomisweb.MaxWorkers) as executor:
+      field_requests = {field: executor.submit(self.__fetch_json, "api/v01/dataset/"+table+"/"+field+".def.sdmx.json?", {})
+                        for field in category_fields}
+      geog_request = executor.submit(self.__fetch_json, "api/v01/dataset/"+table+"/geography/TYPE.def.sdmx.json?", {})
+
+      for field in category_fields:
+        fdata = field_requests[field].result()
+        if not fdata:
+          print("HTTP error requesting metadata for " + table_name)
+          return {}
         values = fdata["structure"]["codelists"]["codelist"][0]["code"]
-        #print(field+":")
         for value in values:
           # KEYs are stored as strings for json compatibility
           fields[field][value["value"]] = value["description"]["value"]
 
-    # Fetch the geographies available for this table
-    geogs = {}
-    path = "api/v01/dataset/"+table+"/geography/TYPE.def.sdmx.json?"
-    try:
-      fdata = self.__fetch_json(path, {})
-    except timeout:
-      print("HTTP timeout requesting geography metadata for " + table_name)
-    except (HTTPError, URLError):
-      print("HTTP error requesting geography metadata for " + table_name)
-    else:
-      if fdata["structure"]["codelists"]:
+      geogs = {}
+      fdata = geog_request.result()
+      if not fdata:
+        print("HTTP error requesting geography metadata for " + table_name)
+      elif fdata["structure"]["codelists"]:
         values = fdata["structure"]["codelists"]["codelist"][0]["code"]
-        #print(values)
         for value in values:
           geogs[str(value["value"])] = value["description"]["value"]
 
@@ -334,6 +541,18 @@ class Nomisweb:
 
 # private
 
+  # the nomis codes for local authorities, loaded on first use
+  def __lad_codes(self):
+    with self.__lad_codes_lock:
+      if self.__cached_lad_codes is None:
+        codes = self.__cache_lad_codes()
+        # don't remember a failure
+        if not codes:
+          return codes
+        # also a static member
+        self.__cached_lad_codes = Nomisweb.cached_lad_codes = codes
+      return self.__cached_lad_codes
+
   # download and cache the nomis codes for local authorities
   def __cache_lad_codes(self):
 
@@ -364,6 +583,342 @@ class Nomisweb:
         codes = json.load(cached_ladcodes)
     return codes
 
+  # removes duplicates, converts country names to codes and replaces LAD codes with a single parent code where possible
+  def __coverage_codes(self, la_codes):
+    countries = [Nomisweb.GeoCodeLookup[k] for k in ["EnglandWales", "GB", "UK"]]
+    codes = []
+    for la_code in la_codes:
+      code = str(Nomisweb.GeoCodeLookup.get(la_code, la_code))
+      if code not in codes:
+        codes.append(code)
+
+    # no need to load the LAD codes for a single area
+    if len(codes) < 2:
+      return codes
+
+    lad_codes = self.__lad_codes()
+    lad_codes = set(str(code) for code in lad_codes.values()) if lad_codes else set()
+    # if a country is already present, any LADs in E&W are redundant
+    if any(code in countries for code in codes):
+      return [code for code in codes if code not in lad_codes]
+    # if the coverage is every LAD in E&W, use the parent instead
+    if lad_codes and lad_codes.issubset(codes):
+      return [Nomisweb.GeoCodeLookup["EnglandWales"]] + [code for code in codes if code not in lad_codes]
+    return codes
+
+  # get the nomis codes for areas of a given type within a single (LA or larger) area, using the cache if possible
+  # returns the codes in shortened form
+  def __fetch_geo_codes(self, la_code, code_type):
+    key = str(la_code) + ":" + code_type
+    cached_geo_codes = self.__cached_geo_codes()
+    if key in cached_geo_codes:
+      return cached_geo_codes[key]
+
+    path = "api/v01/dataset/NM_144_1/geography/" + str(la_code) + code_type + ".def.sdmx.json?"
+    rawdata = self.__fetch_json(path, {})
+
+    # use try-catch block to deal with any issues arising from the returned json
+    # which are likely due to invalid/empty LA codes
+    try:
+      codes = _shorten([code["value"] for code in rawdata["structure"]["codelists"]["codelist"][0]["code"]])
+    except (KeyError, IndexError, ValueError):
+      print(la_code, " does not appear to be a valid LA code")
+      return ""
+    with self.__geo_codes_lock:
+      self.__geo_codes[key] = codes
+      self.__geo_codes_dirty = True
+    return codes
+
+  # the cached geography code lookups, loaded on first use
+  def __cached_geo_codes(self):
+    with self.__geo_codes_lock:
+      if self.__geo_codes is None:
+        filename = self.cache_dir / "geo_codes.json"
+        if self.verbose and os.path.isfile(str(filename)): print("using cached geography codes:", filename)
+        self.__geo_codes = self.__read_geo_codes(filename)
+      return self.__geo_codes
+
+  # a missing or corrupt (e.g. truncated) file is treated as empty, i.e. the lookups will just be fetched again
+  # (lookups cached by earlier versions as lists of codes are shortened)
+  def __read_geo_codes(self, filename):
+    if not os.path.isfile(str(filename)):
+      return {}
+    try:
+      with open(str(filename)) as cached_geocodes:
+        codes = json.load(cached_geocodes)
+    except ValueError:
+      print("WARNING: ignoring corrupt cached geography codes:", filename)
+      return {}
+    return {key: value if isinstance(value, str) else _shorten(value) for key, value in codes.items()}
+
+  # save the geography code lookups, if any have been added, merged with any saved by other instances
+  # (written to a temporary file first, so the cached copy is never incomplete)
+  def __save_geo_codes(self):
+    with self.__geo_codes_lock:
+      if not self.__geo_codes_dirty:
+        return
+      filename = self.cache_dir / "geo_codes.json"
+      if self.verbose: print("Writing geography codes to ", filename)
+      codes = self.__read_geo_codes(filename)
+      codes.update(self.__geo_codes)
+      tmp_file = str(filename) + ".%d.%d.tmp" % (os.getpid(), threading.get_ident())
+      with open(tmp_file, "w") as geofile:
+        json.dump(codes, geofile)
+      os.replace(tmp_file, str(filename))
+      self.__geo_codes = codes
+      self.__geo_codes_dirty = False
+
+  # the cache filename for a query, which is based on a hash of the query url without the API key
+  # data cached under the previous (key-dependent) name is renamed
+  def __cache_filename(self, table, table_internal, query):
+    query_string = self.get_url(table_internal, query)
+    filename = self.cache_dir / (table + "_" + hashlib.md5(query_string.encode()).hexdigest() + ".tsv")
+    if not os.path.isfile(str(filename)) and self.key is not None:
+      legacy_string = self.get_url(table_internal, dict(query, uid=self.key))
+      legacy_filename = self.cache_dir / (table + "_" + hashlib.md5(legacy_string.encode()).hexdigest() + ".tsv")
+      if os.path.isfile(str(legacy_filename)):
+        os.replace(str(legacy_filename), str(filename))
+    return filename
+
+  # write (combined) data to the cache, via a temporary file so the cached data is never incomplete
+  def __write_tsv(self, data, filename):
+    tmp_file = str(filename) + ".%d.%d.tmp" % (os.getpid(), threading.get_ident())
+    data.to_csv(tmp_file, sep="\t", index=False)
+    os.replace(tmp_file, str(filename))
+
+  # records access to cached data, adding it to the manifest if necessary (which may evict older data)
+  def __update_manifest(self, filename, table, query):
+    if not self.manifest.touch(filename):
+      self.manifest.add(filename, table, query)
+
+  # serves a query from a cache of data for the same table and query (excluding geography) that is extended by downloading
+  # only the areas not already held. The GEOGRAPHY column (nomis area code) is always stored, to identify the areas.
+  # Returns None if the query isn't suitable (i.e. the geography isn't a list of numeric codes)
+  def __get_data_incremental(self, table, metadata, query, columns):
+    geog_key = next((k for k in query if k.upper() == "GEOGRAPHY"), None)
+    if geog_key is None or "RecordOffset" in query:
+      return None
+    # the per-area data is only held as a binary copy
+    if not utils.columnar_available():
+      if self.verbose: print("pyarrow is not available, the data is cached per query rather than per area")
+      return None
+    try:
+      requested = _expand(query[geog_key])
+    except ValueError:
+      return None
+
+    # the query (without geography) that the cached data corresponds to
+    base_query = {k: v for k, v in query.items() if k != geog_key}
+    selected = None
+    select_key = next((k for k in query if k.lower() == "select"), None)
+    if select_key is not None:
+      selected = [column.strip() for column in query[select_key].split(",") if column.strip()]
+      if "GEOGRAPHY" not in selected:
+        base_query[select_key] = ",".join(["GEOGRAPHY"] + selected)
+
+    base_query_string = self.get_url(metadata["nomis_table"], base_query)
+    store = self.cache_dir / (table + "_" + hashlib.md5(base_query_string.encode()).hexdigest() + "_geog.tsv")
+    index_file = store.with_suffix(".json")
+
+    with self.__incremental_lock:
+      held = set()
+      data = None
+      if os.path.isfile(str(index_file)):
+        with open(str(index_file)) as index:
+          held = set(json.load(index)["geographies"])
+        data = utils.read_columnar(store)
+        if data is None:
+          held = set()
+
+      missing = sorted(set(requested) - held)
+      if missing:
+        if self.verbose: print("Downloading data for %d of %d areas" % (len(missing), len(requested)))
+        delta_query = dict(base_query, **{geog_key: _shorten(missing)})
+        delta = self.get_data(table, dict(delta_query))
+        if delta is None:
+          return None
+        # can't be merged into the incremental cache by area, so answer the query in full instead
+        if "GEOGRAPHY" not in delta.columns:
+          return None
+        # the delta is now held in the incremental cache, so the separately cached copy is redundant
+        delta_file = self.__cache_filename(table, metadata["nomis_table"], delta_query)
+        for f in self.cache_dir.glob(delta_file.stem + ".*"):
+          f.unlink()
+        self.manifest.remove(delta_file)
+
+        data = delta if data is None else pd.concat([data, delta], ignore_index=True)
+        held.update(missing)
+        # write the data before the index, so the index never refers to data that isn't there
+        if not utils.write_columnar(data, store):
+          return None
+        tmp_file = str(index_file) + ".tmp"
+        with open(tmp_file, "w") as index:
+          json.dump({"query": base_query, "geographies": sorted(held)}, index)
+        os.replace(tmp_file, str(index_file))
+      elif self.verbose:
+        print("Using cached data for all %d areas: %s" % (len(requested), store))
+
+      self.__update_manifest(store, table, base_query)
+
+    data = data[data["GEOGRAPHY"].isin(requested)].sort_values("GEOGRAPHY", kind="stable").reset_index(drop=True)
+    if selected is not None:
+      data = data[selected]
+    if columns is not None:
+      data = data[columns]
+    return data
+
+  # looks for cached data for the same table whose query is a superset of this one (i.e. selects the same or more
+  # columns, geographies and/or category values, but is otherwise identical) and if found, filters it to answer the query.
+  # Returns None if there is no suitable cached data
+  def __get_data_from_superset(self, table, metadata, query):
+    if "RecordOffset" in query:
+      return None
+    dimensions = {field.upper(): _dimension_values(values) for field, values in metadata["fields"].items()}
+    params = {k.upper(): v for k, v in query.items()}
+    for filename, entry in self.manifest.find(table).items():
+      # only regular (not incremental or aggregated) cached data
+      if not filename.name.endswith(".tsv") or filename.name.endswith(("_geog.tsv", "_rollup.tsv")) \
+        or not os.path.isfile(str(filename)):
+        continue
+      filters = _superset_filters(dimensions, params, {k.upper(): v for k, v in entry["query"].items()})
+      if filters is None:
+        continue
+      selected = _selected_columns(params)
+      # the columns we need to filter on and return must be present in the cached data
+      data = utils.read_columnar(filename)
+      if data is None:
+        data = pd.read_csv(str(filename), delimiter='\t')
+      if not set(filters).issubset(data.columns) or (selected is not None and not set(selected).issubset(data.columns)):
+        continue
+      if self.verbose: print("Answering query from cached data: " + str(filename))
+      self.__update_manifest(filename, table, entry["query"])
+      for column, values in filters.items():
+        data = data[data[column].isin(values)]
+      if selected is not None:
+        data = data[selected]
+      return data.reset_index(drop=True)
+    return None
+
+  # the E&W geography lookup, loaded on first use. None if it hasn't been generated
+  def __get_ew_lookup(self):
+    if self.__ew_lookup is None:
+      filename = self.cache_dir / "ew_lookup.csv"
+      if os.path.isfile(str(filename)):
+        self.__ew_lookup = pd.read_csv(str(filename), dtype=str)
+    return self.__ew_lookup
+
+  # answers a query for counts at a given resolution by aggregating cached data for the same areas at a finer resolution.
+  # the geography must be in the form <area(s)>TYPE<type> and the measure must be counts (which are additive)
+  # Returns None if this isn't possible
+  def __get_data_rollup(self, table, metadata, query):
+    params = {k.upper(): v for k, v in query.items()}
+    geog_key = next((k for k in query if k.upper() == "GEOGRAPHY"), None)
+    if geog_key is None or params.get("MEASURES") != "20100" or "TYPE" not in query[geog_key]:
+      return None
+    lookup = self.__get_ew_lookup()
+    if lookup is None:
+      return None
+
+    # all areas must be of the same type
+    areas = query[geog_key].split(",")
+    geog_type = areas[0][areas[0].index("TYPE"):]
+    resolution = next((k for k, v in Nomisweb.GeoCodeLookup.items() if v == geog_type), None)
+    if resolution not in Nomisweb.Hierarchy or not all(area.endswith(geog_type) for area in areas):
+      return None
+
+    # we need the area codes in the finer data, but (of course) not the area-specific columns
+    selected = _selected_columns(params)
+    if selected is not None:
+      if any(column in Nomisweb.NonAdditiveColumns for column in selected):
+        return None
+      fine_selected = selected if "GEOGRAPHY_CODE" in selected else ["GEOGRAPHY_CODE"] + selected
+
+    # use the coarsest finer resolution that's cached
+    for fine_resolution in reversed(Nomisweb.Hierarchy[:Nomisweb.Hierarchy.index(resolution)]):
+      fine_type = Nomisweb.GeoCodeLookup[fine_resolution]
+      fine_query = dict(query, **{geog_key: ",".join(area.replace(geog_type, fine_type) for area in areas)})
+      if selected is not None:
+        select_key = next(k for k in query if k.upper() == "SELECT")
+        fine_query[select_key] = ",".join(fine_selected)
+      data = self.__get_data_from_superset(table, metadata, fine_query)
+      if data is None or "GEOGRAPHY_CODE" not in data.columns:
+        continue
+
+      if self.verbose: print("Aggregating %s data to %s" % (fine_resolution, resolution))
+      mapping = pd.Series(lookup[resolution].values, index=lookup[fine_resolution].values)
+      mapping = mapping[~mapping.index.duplicated()]
+      data = data.drop([column for column in Nomisweb.NonAdditiveColumns if column in data.columns], axis=1)
+      data["GEOGRAPHY_CODE"] = data["GEOGRAPHY_CODE"].map(mapping)
+      if data["GEOGRAPHY_CODE"].isnull().any():
+        # areas missing from the lookup
+        continue
+      keys = [column for column in data.columns if column != "OBS_VALUE"]
+      data = data.groupby(keys, sort=False, as_index=False, dropna=False)["OBS_VALUE"].sum()
+      if selected is not None:
+        data = data[selected]
+      return data
+    return None
+
+  # estimates (a lower bound on) the number of rows a query will return, and thus the number of pieces it needs to be split into
+  # only applicable when the geography is an explicit list of numeric codes, and not to a page of a query (which is never split again)
+  def __predict_pieces(self, metadata, query_params):
+    params = {k.upper(): v for k, v in query_params.items()}
+    if "GEOGRAPHY" not in params or "RECORDOFFSET" in params:
+      return 1
+    rows = _count_values(params["GEOGRAPHY"])
+    if rows is None:
+      return 1
+    for field in metadata["fields"]:
+      if field.upper() != "GEOGRAPHY" and field.upper() in params:
+        rows *= _count_values(params[field.upper()]) or 1
+    return rows // Nomisweb.RowLimit + 1
+
+  # splits a query into smaller ones, by geography if possible, otherwise by record offset
+  # the pieces are downloaded concurrently and each is cached separately, so a failure doesn't invalidate the others.
+  # Returns None if any piece is unavailable (so an incomplete result is never cached as the whole query's data)
+  def __get_data_split(self, table, params, pieces, first_page=None):
+    geog_key = next((k for k in params if k.upper() == "GEOGRAPHY"), None)
+
+    try:
+      geographies = _split_codes(params[geog_key], pieces) if geog_key else []
+    except ValueError:
+      geographies = []
+
+    # can't split by geography (single area or not a list of numeric codes), page through the records instead
+    if len(geographies) < 2:
+      return self.__get_data_paged(table, params, first_page)
+
+    queries = [dict(params, **{geog_key: geography}) for geography in geographies]
+    with ThreadPoolExecutor(max_workers=Nomisweb.MaxWorkers) as executor:
+      results = list(executor.map(lambda query: self.get_data(table, query), queries))
+    if any(result is None for result in results):
+      if self.verbose: print("%d of %d pieces of the query are unavailable" % (sum(result is None for result in results), len(results)))
+      return None
+    return pd.concat(results, ignore_index=True)
+
+  # fetches successive pages of (at most) RowLimit rows, MaxWorkers at a time, until a page is not full
+  # first_page, if given, is the (already downloaded) data at offset zero.
+  # Returns None if any page is unavailable
+  def __get_data_paged(self, table, query_params, first_page=None):
+    results = [] if first_page is None else [first_page]
+    page = len(results)
+    while True:
+      queries = [dict(query_params, RecordOffset=str((page + i) * Nomisweb.RowLimit)) for i in range(Nomisweb.MaxWorkers)]
+      page += Nomisweb.MaxWorkers
+      with ThreadPoolExecutor(max_workers=Nomisweb.MaxWorkers) as executor:
+        batch = list(executor.map(lambda query: self.get_data(table, query), queries))
+      for result in batch:
+        # no data is the end of the records, except offline where the page (which would be cached if it had data) may
+        # simply not have been downloaded
+        if result is None and self.offline_mode:
+          if self.verbose: print("Page at offset %d of the query is unavailable" % (len(results) * Nomisweb.RowLimit))
+          return None
+        if result is None or result.empty:
+          return pd.concat(results, ignore_index=True) if results else None
+        results.append(result)
+        if len(result) < Nomisweb.RowLimit:
+          return pd.concat(results, ignore_index=True)
+
   # given a list of integer codes, generates a string using the nomisweb shortened form
   # (consecutive numbers represented by a range, non-consecutive are comma separated
   def __fetch_json(self, path, query_params):
@@ -373,16 +928,40 @@ class Nomisweb:
     query_string = Nomisweb.URL + path + str(urlencode(query_params))
 
     reply = {}
+    if self.offline_mode:
+      print('ERROR: operating in offline mode\n', query_string)
+      return reply
     try:
-      response = request.urlopen(query_string, timeout=Nomisweb.Timeout)
-    except (HTTPError, URLError) as error:
-      print('ERROR: ', error, '\n', query_string)
-    except timeout:
+      with self.__requests:
+        response = transport.get(query_string, timeout=Nomisweb.Timeout)
+      response.raise_for_status()
+    except requests.exceptions.Timeout:
       print('ERROR: request timed out\n', query_string)
+    except requests.exceptions.RequestException as error:
+      print('ERROR: ', error, '\n', query_string)
     else:
-      reply = json.loads(response.read().decode("utf-8"))
+      reply = response.json()
     return reply
 
+  def make_ew_lookup(self, source):
+    """
+    Generates the E&W geography lookup (ew_lookup.csv in the cache directory), used to aggregate fine resolution data.
+    The source is the ONS "Output Area to Lower Layer Super Output Area to Middle Layer Super Output Area to
+    Local Authority District (December 2011) Lookup in England and Wales" csv file, available from the ONS Open Geography Portal
+    (https://geoportal.statistics.gov.uk)
+    Args:
+        source: path or url of the ONS lookup csv
+    Returns:
+        the lookup
+    """
+    lookup = pd.read_csv(source, usecols=["OA11CD", "LSOA11CD", "MSOA11CD", "LAD11CD"], dtype=str)
+    # same layout as the Scottish lookup
+    lookup = lookup[["OA11CD", "LSOA11CD", "MSOA11CD", "LAD11CD"]]
+    lookup.columns = Nomisweb.Hierarchy
+    lookup.to_csv(str(self.cache_dir / "ew_lookup.csv"), index=False)
+    self.__ew_lookup = None
+    return lookup
+
   # save metadata as JSON for future reference
   def write_metadata(self, table, meta):
     """method.
@@ -0,0 +1,189 @@
+"""
+UK-wide census data, federated across the nomisweb (England & Wales), NRScotland and NISRA data providers.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+import ukcensusapi.Nomisweb as ApiEW
+import ukcensusapi.NRScotland as ApiSC
+import ukcensusapi.NISRA as ApiNI
+
+def _nation(code):
+  """
+  Returns the nation an area code (ONS code, or NI LGD code) is in
+  """
+  if code[:1] in ["E", "W"]:
+    return "EW"
+  elif code[:1] == "S":
+    return "SC"
+  elif code[:1] == "N" or code[:2] == "95":
+    return "NI"
+  else:
+    raise ValueError("Invalid code: {}".format(code))
+
+def _categories(data, fields):
+  """
+  Returns the descriptions of each row's category values (for multiple categories, comma separated)
+  Args:
+    data: the data
+    fields: {column: {value: description}} for each category column
+  """
+  if not fields:
+    return pd.Series("", index=data.index)
+  descriptions = [data[column].map(lookup) for column, lookup in fields.items()]
+  category = descriptions[0]
+  for description in descriptions[1:]:
+    category = category + ", " + description
+  return category
+
+class UKCensus:
+  """
+  Queries the census data for the whole (or any part) of the UK in one step. The data for each nation is obtained
+  from its own provider, concurrently, and returned as a single table in a consistent format.
+  """
+
+  Nations = ["EW", "SC", "NI"]
+
+  # the resolutions available in every nation (by aggregation where the provider doesn't supply them)
+  Resolutions = ["LAD", "MSOA11", "LSOA11", "OA11"]
+
+  # the (ONS) codes for countries, mapped to the nation(s) they cover and the coverage within each nation
+  Countries = {
+    "K02000001": {"EW": ["EnglandWales"], "SC": ["S92000003"], "NI": ["N92000002"]},
+    "K03000001": {"EW": ["EnglandWales"], "SC": ["S92000003"]},
+    "K04000001": {"EW": ["EnglandWales"]},
+    "E92000001": {"EW": ["England"]},
+    "S92000003": {"SC": ["S92000003"]},
+    "N92000002": {"NI": ["N92000002"]}
+  }
+
+  # E&W categories that only split the totals, and aren't present in the other nations' data
+  EWTotals = {"RURAL_URBAN": 0}
+
+  def __init__(self, cache_dir, verbose=False, offline=False):
+    """Constructor.
+    Args:
+        cache_dir: cache directory (shared by all the providers)
+        verbose: print diagnostic information
+        offline: don't make any network requests, i.e. use pre-cached data only
+    Returns:
+        an instance.
+    """
+    # nothing is downloaded (or checked online) until it's needed
+    self.api_ew = ApiEW.Nomisweb(cache_dir, verbose=verbose, offline=offline)
+    self.api_sc = ApiSC.NRScotland(cache_dir, offline=offline)
+    self.api_ni = ApiNI.NISRA(cache_dir, offline=offline)
+    self.cache_dir = self.api_ew.cache_dir
+
+  def get_data(self, table, resolution, coverage="K02000001"):
+    """Downloads or retrieves data for a table from every nation in the coverage, concurrently.
+    Args:
+       table: the table name without the nation suffix (e.g. "KS401", for KS401EW, KS401SC and KS401NI), or a dict
+         of the table name for each nation where the names don't correspond (e.g. {"EW": "QS202EW", "NI": "QS202NI"})
+       resolution: the geographical resolution, one of UKCensus.Resolutions
+       coverage: country code(s) (see UKCensus.Countries, default the UK), and/or the codes of local authorities
+         (E&W LAD, Scottish Council Area or NI LGD codes)
+    Returns:
+        a dataframe with columns NATION, TABLE, GEOGRAPHY_CODE, CATEGORY (the category description, or descriptions
+        comma separated, as the category codes differ between the nations' tables) and OBS_VALUE
+    """
+    if resolution not in UKCensus.Resolutions:
+      raise ValueError("resolution '{}' is not available (must be one of {})".format(resolution, UKCensus.Resolutions))
+
+    coverages = self.__coverages(coverage)
+    tables = table if isinstance(table, dict) else {nation: table + nation for nation in coverages}
+    missing = [nation for nation in coverages if nation not in tables]
+    if missing:
+      raise ValueError("no table specified for {}".format(missing))
+
+    get_data = {"EW": self.__get_data_ew, "SC": self.__get_data_sc, "NI": self.__get_data_ni}
+    with ThreadPoolExecutor(max_workers=len(coverages) or 1) as executor:
+      futures = [(nation, executor.submit(get_data[nation], tables[nation], resolution, coverages[nation]))
+                 for nation in UKCensus.Nations if nation in coverages]
+      results = [self.__harmonise(nation, tables[nation], *future.result()) for nation, future in futures]
+
+    if not results:
+      return self.__harmonise(None, None, pd.DataFrame({"GEOGRAPHY_CODE": [], "OBS_VALUE": []}), {})
+    return pd.concat(results, ignore_index=True)
+
+# private
+
+  # splits the coverage into the area codes within each nation
+  def __coverages(self, coverage):
+    if isinstance(coverage, str):
+      coverage = [coverage]
+    coverages = {}
+    for code in coverage:
+      nation_coverages = UKCensus.Countries[code] if code in UKCensus.Countries else {_nation(code): [code]}
+      for nation, nation_codes in nation_coverages.items():
+        codes = coverages.setdefault(nation, [])
+        codes.extend(nation_code for nation_code in nation_codes if nation_code not in codes)
+    return coverages
+
+  # returns the data and the descriptions of the values in its category columns
+  def __get_data_ew(self, table, resolution, coverage):
+    meta = self.api_ew.load_metadata(table)
+    if not meta:
+      raise ValueError("Table {}: metadata not available from nomisweb".format(table))
+
+    # ONS LAD codes need converting to nomis codes
+    la_codes = [code if code in ApiEW.Nomisweb.GeoCodeLookup else self.__nomis_lad_code(code) for code in coverage]
+
+    query_params = {"date": "latest",
+                    "geography": self.api_ew.get_geo_codes(la_codes, ApiEW.Nomisweb.GeoCodeLookup[resolution]),
+                    "MEASURES": "20100"}
+    fields = {}
+    for field, values in meta["fields"].items():
+      if field in ["GEOGRAPHY", "MEASURES", "FREQ"]:
+        continue
+      if field in UKCensus.EWTotals:
+        query_params[field] = str(UKCensus.EWTotals[field])
+        continue
+      # KEYs are strings if the metadata has been loaded from json
+      fields[field] = {int(k): v for k, v in values.items()}
+      query_params[field] = ",".join(str(k) for k in fields[field])
+    query_params["select"] = ",".join(["GEOGRAPHY_CODE"] + list(fields) + ["OBS_VALUE"])
+
+    data = self.api_ew.get_data(table, query_params)
+    if not isinstance(data, pd.DataFrame):
+      raise ValueError("Table {}: data not available from nomisweb".format(table))
+    return data, fields
+
+  def __get_data_sc(self, table, resolution, coverage):
+    # Intermediate zone (~MSOA) data is aggregated from data zones
+    if resolution not in ApiSC.NRScotland.GeoCodeLookup and resolution != "MSOA11":
+      raise ValueError("resolution '{}' is not available for Scotland".format(resolution))
+    data = self.api_sc.get_data(table, coverage, resolution)
+    meta = self.api_sc.get_metadata(table, resolution if resolution != "MSOA11" else "LSOA11")
+    # the main category is a dict, the others lists of the values
+    fields = {}
+    for i in range(len(meta["fields"])):
+      values = meta["fields"][table + "_" + str(i) + "_CODE"]
+      fields[table + "_" + str(i) + "_CODE"] = values if isinstance(values, dict) else dict(enumerate(values))
+    return data, fields
+
+  def __get_data_ni(self, table, resolution, coverage):
+    resolution = ApiNI._ni_resolution(resolution)
+    data = self.api_ni.get_data(table, coverage, resolution)
+    meta = self.api_ni.get_metadata(table, resolution)
+    fields = {table + "_" + str(i) + "_CODE": meta["fields"][table + "_" + str(i) + "_CODE"] for i in range(len(meta["fields"]))}
+    return data, fields
+
+  def __nomis_lad_code(self, code):
+    nomis_codes = self.api_ew.get_lad_codes(code)
+    if not nomis_codes:
+      raise ValueError("Invalid code: {}".format(code))
+    return str(nomis_codes[0])
+
+  # converts a nation's data to the common format
+  def __harmonise(self, nation, table, data, fields):
+    values = data["OBS_VALUE"]
+    integral = np.issubdtype(values.dtype, np.integer) or (values.notna().all() and (values % 1 == 0).all())
+    return pd.DataFrame({"NATION": nation,
+                         "TABLE": table,
+                         "GEOGRAPHY_CODE": data["GEOGRAPHY_CODE"].astype(str),
+                         "CATEGORY": _categories(data, fields).astype(str),
+                         "OBS_VALUE": values.astype(np.int64 if integral else np.float64)},
+                        columns=["NATION", "TABLE", "GEOGRAPHY_CODE", "CATEGORY", "OBS_VALUE"]).reset_index(drop=True)
@@ -0,0 +1,141 @@
+"""
+Downloading and validation of the bulk data archives used by the NRScotland and NISRA scrapers.
+Archives are downloaded concurrently (and interrupted downloads resumed, see transport.download). Each completed
+download is checked to be a valid zip archive and its size and SHA-256 checksum are recorded in a manifest
+(archives.json) in the cache directory, so that cached archives can later be validated.
+"""
+
+import os
+import json
+import hashlib
+import threading
+import zipfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import ukcensusapi.transport as transport
+
+# maximum number of concurrent downloads
+MAX_WORKERS = 4
+
+MANIFEST = "archives.json"
+
+# serialises downloads of the same file, and updates to the manifests
+_locks = {}
+_locks_lock = threading.Lock()
+_manifest_lock = threading.Lock()
+
+def fetch(url, filename, legacy_tls=False, verbose=True):
+  """
+  Downloads an archive, unless it's already present and the same size as when it was downloaded.
+  Args:
+    url: the url of the archive
+    filename: the local file
+    legacy_tls: see transport.session
+    verbose: report progress
+  Returns:
+    the filename
+  Raises:
+    RuntimeError if the downloaded file isn't a valid zip archive
+  """
+  filename = Path(filename)
+  with _lock(filename):
+    if filename.is_file():
+      entry = _load_manifest(filename.parent).get(filename.name)
+      if entry is None or entry["size"] == filename.stat().st_size:
+        return filename
+      # truncated or otherwise modified since downloaded
+      if verbose: print("%s has changed size since it was downloaded, downloading again" % filename)
+      filename.unlink()
+
+    if verbose: print(url, " -> ", filename, "...")
+    transport.download(url, filename, progress=_Progress(filename.name) if verbose else None, legacy_tls=legacy_tls)
+    if not zipfile.is_zipfile(str(filename)):
+      filename.unlink()
+      raise RuntimeError("%s: downloaded file is not a valid zip archive" % url)
+    _record(filename, url)
+    if verbose: print("%s OK" % filename)
+  return filename
+
+def download(archives, max_workers=None, verbose=True):
+  """
+  Downloads (see fetch) several archives concurrently.
+  Args:
+    archives: a list of (url, filename, legacy_tls) tuples
+    max_workers: the maximum number of concurrent downloads (default MAX_WORKERS)
+    verbose: report progress
+  Returns:
+    the filenames
+  """
+  with ThreadPoolExecutor(max_workers=max_workers or MAX_WORKERS) as executor:
+    futures = [executor.submit(fetch, url, filename, legacy_tls, verbose) for url, filename, legacy_tls in archives]
+    return [future.result() for future in futures]
+
+def verify(cache_dir):
+  """
+  Checks the checksum of every archive in the cache directory's manifest.
+  Returns the filenames of any archives that are missing or don't match (i.e. are corrupt)
+  """
+  cache_dir = Path(cache_dir)
+  invalid = []
+  for name, entry in _load_manifest(cache_dir).items():
+    filename = cache_dir / name
+    if not filename.is_file() or filename.stat().st_size != entry["size"] or _sha256(filename) != entry["sha256"]:
+      invalid.append(filename)
+  return invalid
+
+def prefetch_all(cache_dir, max_workers=None, verbose=True):
+  """
+  Downloads (if necessary) every NRScotland and NISRA source archive into the cache directory, concurrently
+  Returns:
+    the filenames
+  """
+  # imported here as the scrapers themselves depend on this module
+  import ukcensusapi.NRScotland as Api_SC
+  import ukcensusapi.NISRA as Api_NI
+  archives = Api_SC.NRScotland(cache_dir).sources() + Api_NI.NISRA(cache_dir).sources()
+  return download(archives, max_workers=max_workers, verbose=verbose)
+
+class _Progress:
+  """
+  Reports download progress every 10%
+  """
+  def __init__(self, name):
+    self.name = name
+    self.reported = 0
+
+  def __call__(self, received, total):
+    if not total:
+      return
+    percent = 100 * received // total // 10 * 10
+    if percent > self.reported:
+      self.reported = percent
+      print("%s: %d%% (%.1f of %.1f MB)" % (self.name, percent, received / 1e6, total / 1e6))
+
+def _lock(filename):
+  with _locks_lock:
+    return _locks.setdefault(str(filename), threading.Lock())
+
+def _load_manifest(cache_dir):
+  filename = Path(cache_dir) / MANIFEST
+  if not filename.is_file():
+    return {}
+  with open(str(filename)) as manifest_file:
+    return json.load(manifest_file)
+
+def _record(filename, url):
+  with _manifest_lock:
+    manifest = _load_manifest(filename.parent)
+    manifest[filename.name] = {"url": url, "size": filename.stat().st_size, "sha256": _sha256(filename)}
+    manifest_file = filename.parent / MANIFEST
+    tmp_file = manifest_file.with_suffix(".tmp")
+    with open(str(tmp_file), "w") as fd:
+      json.dump(manifest, fd, indent=2)
+    os.replace(str(tmp_file), str(manifest_file))
+
+def _sha256(filename):
+  sha256 = hashlib.sha256()
+  with open(str(filename), "rb") as fd:
+    for chunk in iter(lambda: fd.read(1024*1024), b""):
+      sha256.update(chunk)
+  return sha256.hexdigest()
@@ -0,0 +1,204 @@
+"""
+Cache manifest: records what is in a cache directory and evicts the least recently used data when it grows too large
+"""
+
+import os
+import json
+import time
+import atexit
+import weakref
+import threading
+import contextlib
+from pathlib import Path
+
+# for locking the manifest against other processes (not available on windows)
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+# serialises access to each manifest file by any instance in this process
+_locks = {}
+_locks_lock = threading.Lock()
+
+# instances with access times still to be written
+_instances = weakref.WeakSet()
+
+@atexit.register
+def _flush_all():
+  for manifest in list(_instances):
+    try:
+      manifest.flush()
+    except OSError:
+      # e.g. the cache directory has been removed
+      pass
+
+class Manifest:
+  """
+  A manifest of cached data files, persisted as json in the cache directory.
+  Each entry is keyed on the data filename and records the table, query, size (including any derived files with the same
+  stem, e.g. binary copies), creation and last access time.
+  The manifest file is shared by every instance (and process) using the cache directory: it is re-read, under a lock,
+  before each update and each update is written back straight away, so no instance's entries are lost. Access times
+  (which change on every cache hit) are held in memory and written in batches (see touch).
+  """
+
+  FILENAME = "cache_manifest.json"
+
+  # the longest (in seconds) that access times are held in memory before being written
+  FLUSH_INTERVAL = 30
+
+  def __init__(self, cache_dir, budget=None):
+    """Constructor.
+    Args:
+        cache_dir: cache directory
+        budget: maximum total size in bytes of the files in the manifest, or None for no limit
+    Returns:
+        an instance.
+    """
+    self.cache_dir = Path(cache_dir)
+    self.budget = budget
+    self.filename = self.cache_dir / Manifest.FILENAME
+    with _locks_lock:
+      self.lock = _locks.setdefault(str(self.filename.resolve()), threading.Lock())
+    self.entries = self.__load()
+    # access times not yet written, {name: time}
+    self.__accessed = {}
+    self.__flushed = time.time()
+
+  def add(self, filename, table, query):
+    """
+    Adds (or updates) an entry and evicts older entries if the cache is over budget
+    Args:
+      filename: the data file
+      table: the table name
+      query: the query parameters (which must not contain credentials)
+    """
+    filename = Path(filename)
+    now = time.time()
+    with self.__locked(save=True):
+      self.entries[filename.name] = {"table": table,
+                                     "query": query,
+                                     "size": self.__size(filename),
+                                     "created": now,
+                                     "accessed": now}
+      self.__evict(protect=filename.name)
+
+  def touch(self, filename):
+    """
+    Records an access to an entry. Returns False if there is no such entry.
+    The access time (and the entry's size, which may have changed) is written when the manifest is next updated, or
+    after at most FLUSH_INTERVAL seconds, or by flush(), so that a cache hit doesn't usually rewrite the manifest
+    """
+    name = Path(filename).name
+    with self.lock:
+      known = name in self.entries
+    if not known:
+      # may have been added by another instance
+      with self.__locked():
+        known = name in self.entries
+      if not known:
+        return False
+    now = time.time()
+    with self.lock:
+      self.__accessed[name] = now
+      _instances.add(self)
+      due = now - self.__flushed >= Manifest.FLUSH_INTERVAL
+    if due:
+      self.flush()
+    return True
+
+  def flush(self):
+    """
+    Writes any access times recorded by touch to the manifest
+    """
+    with self.lock:
+      if not self.__accessed:
+        return
+    with self.__locked(save=True):
+      pass
+
+  def remove(self, filename):
+    """
+    Removes an entry (but not the file)
+    """
+    with self.__locked(save=True):
+      self.entries.pop(Path(filename).name, None)
+
+  def find(self, table):
+    """
+    Returns {filename: entry} for every cached file for the given table
+    """
+    with self.__locked():
+      return {self.cache_dir / name: dict(entry) for name, entry in self.entries.items() if entry["table"] == table}
+
+  def total_size(self):
+    """
+    Returns the total size in bytes of the files in the manifest
+    """
+    with self.__locked():
+      return sum(entry["size"] for entry in self.entries.values())
+
+  def evict(self):
+    """
+    Removes least recently accessed files until the cache is within budget
+    """
+    with self.__locked(save=True):
+      self.__evict()
+
+  # the total size of a file and any others with the same stem
+  def __size(self, filename):
+    return sum(f.stat().st_size for f in self.cache_dir.glob(filename.stem + ".*") if f.is_file())
+
+  def __evict(self, protect=None):
+    if self.budget is None:
+      return
+    total = sum(entry["size"] for entry in self.entries.values())
+    for name in sorted(self.entries, key=lambda name: self.entries[name]["accessed"]):
+      if total <= self.budget:
+        break
+      if name == protect:
+        continue
+      for f in self.cache_dir.glob(Path(name).stem + ".*"):
+        if f.is_file():
+          f.unlink()
+      total -= self.entries.pop(name)["size"]
+
+  # loads the entries, with any access times not yet written, and if they are to be updated holds the lock (against
+  # other instances and processes) and saves them afterwards, including the access times.
+  # (the file is always replaced whole, so it can be read without the lock)
+  @contextlib.contextmanager
+  def __locked(self, save=False):
+    with self.lock, contextlib.ExitStack() as stack:
+      if save:
+        lock_file = stack.enter_context(open(str(self.cache_dir / (Manifest.FILENAME + ".lock")), "a"))
+        if fcntl:
+          fcntl.flock(lock_file, fcntl.LOCK_EX)
+      self.entries = self.__load()
+      for name, accessed in self.__accessed.items():
+        if name in self.entries:
+          self.entries[name]["accessed"] = max(self.entries[name]["accessed"], accessed)
+      yield
+      if save:
+        for name in self.__accessed:
+          if name in self.entries:
+            self.entries[name]["size"] = self.__size(self.cache_dir / name)
+        self.__accessed = {}
+        self.__flushed = time.time()
+        self.__save()
+
+  def __load(self):
+    if not os.path.isfile(str(self.filename)):
+      return {}
+    try:
+      with open(str(self.filename)) as manifest_file:
+        return json.load(manifest_file)
+    except ValueError:
+      # corrupt, start again (the files it referred to are no longer managed)
+      return {}
+
+  def __save(self):
+    tmp_file = self.filename.with_suffix(".%d.%d.tmp" % (os.getpid(), threading.get_ident()))
+    with open(str(tmp_file), "w") as manifest_file:
+      json.dump(self.entries, manifest_file)
+    os.replace(str(tmp_file), str(self.filename))
@@ -0,0 +1,179 @@
+"""
+Integer-coded geographical hierarchies (e.g. OA -> LSOA -> MSOA -> LAD), used to look up and aggregate areas
+"""
+
+import os
+import threading
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+def build(lookup, levels):
+  """
+  Builds a hierarchy from a lookup table
+  Args:
+    lookup: a dataframe with a row for each area at the finest level and a column for each level containing the code
+      of the area (at that level) the row is in
+    levels: the column names, finest first
+  Returns:
+    a Hierarchy
+  """
+  codes = {}
+  ids = {}
+  for level in levels:
+    level_ids, level_codes = pd.factorize(lookup[level].astype(str))
+    ids[level] = level_ids.astype(np.int32)
+    codes[level] = np.asarray(level_codes).astype(str)
+  return Hierarchy(levels, codes, ids)
+
+def load(lookup_file):
+  """
+  Loads the compiled hierarchy saved (by Hierarchy.save) alongside lookup_file.
+  Returns None if there isn't one, or if it's older than lookup_file
+  """
+  filename = _compiled_filename(lookup_file)
+  if not os.path.isfile(str(filename)):
+    return None
+  if os.path.isfile(str(lookup_file)) and os.path.getmtime(str(filename)) < os.path.getmtime(str(lookup_file)):
+    return None
+  with np.load(str(filename)) as arrays:
+    levels = arrays["levels"].tolist()
+    return Hierarchy(levels,
+                     {level: arrays["codes_" + level] for level in levels},
+                     {level: arrays["ids_" + level] for level in levels})
+
+def _compiled_filename(lookup_file):
+  return Path(str(lookup_file)).with_suffix(".npz")
+
+class Hierarchy:
+  """
+  A nested geographical hierarchy. The areas at each level are integer-coded (in order of first appearance in the
+  lookup the hierarchy was built from), so that lookups and aggregations operate on integer arrays rather than codes.
+  Use build() or load() to create an instance.
+  """
+
+  def __init__(self, levels, codes, ids):
+    """Constructor.
+    Args:
+        levels: the level names, finest first
+        codes: {level: array of the area codes at that level}, the position of each code being its integer id
+        ids: {level: array of the integer id, at that level, of the area containing each area at the finest level}
+    Returns:
+        an instance.
+    """
+    self.levels = list(levels)
+    self.codes = codes
+    self.ids = ids
+    self.__index = {level: pd.Index(codes[level]) for level in self.levels}
+    self.__lock = threading.Lock()
+    self.__parents = {}
+    self.__children = {}
+    self.__ranks = {}
+
+  def save(self, lookup_file):
+    """
+    Saves the hierarchy in a compact binary form alongside the lookup file it was built from
+    """
+    filename = _compiled_filename(lookup_file)
+    arrays = {"levels": np.array(self.levels)}
+    for level in self.levels:
+      arrays["codes_" + level] = self.codes[level]
+      arrays["ids_" + level] = self.ids[level]
+    tmp_file = filename.with_suffix(".%d.%d.tmp" % (os.getpid(), threading.get_ident()))
+    with open(str(tmp_file), "wb") as fd:
+      np.savez(fd, **arrays)
+    os.replace(str(tmp_file), str(filename))
+
+  def areas(self, coverage, coverage_level, level):
+    """
+    Returns the codes of all the areas at level within (or, if level is coarser, containing) the coverage area(s),
+    in the order they appear in the lookup. Unknown codes in coverage are ignored
+    """
+    if isinstance(coverage, str):
+      coverage = [coverage]
+    coverage_ids = self.__index[coverage_level].get_indexer(coverage)
+    coverage_ids = coverage_ids[coverage_ids >= 0]
+    if coverage_level == level:
+      ids = np.unique(coverage_ids)
+    elif self.levels.index(level) < self.levels.index(coverage_level):
+      order, offsets = self.__child_index(level, coverage_level)
+      ids = np.unique(np.concatenate([order[offsets[i]:offsets[i + 1]] for i in coverage_ids] + [order[:0]]))
+    else:
+      ids = np.unique(self.parents(coverage_level, level)[coverage_ids])
+    return self.codes[level][ids]
+
+  def lookup(self, codes, level):
+    """
+    Returns the ids of the areas (at level) with the specified codes. Raises ValueError if any are not in the hierarchy
+    """
+    ids = self.__index[level].get_indexer(codes)
+    if (ids < 0).any():
+      raise ValueError("%s areas not in the lookup: %s" % (level, np.unique(np.asarray(codes)[ids < 0])))
+    return ids
+
+  def parents(self, level, parent_level):
+    """
+    Returns an array of the ids of the area at parent_level containing each area at level
+    """
+    key = (level, parent_level)
+    with self.__lock:
+      if key not in self.__parents:
+        parents = np.empty(len(self.codes[level]), dtype=self.ids[parent_level].dtype)
+        parents[self.ids[level]] = self.ids[parent_level]
+        self.__parents[key] = parents
+      return self.__parents[key]
+
+  def aggregate(self, data, level, parent_level, code_column="GEOGRAPHY_CODE", value_column="OBS_VALUE"):
+    """
+    Aggregates (sums) data for areas at level to parent_level, grouping on all the other columns.
+    Returns a dataframe with the same columns (but with the value column last), sorted on the area code and then each
+    of the other columns
+    """
+    columns = [column for column in data.columns if column != value_column]
+    if data.empty:
+      return data[columns + [value_column]].reset_index(drop=True)
+
+    ids = self.lookup(data[code_column], level)
+
+    # integer keys for each column (ordered as the values are), combined into a single group key
+    keys = []
+    uniques = []
+    for column in columns:
+      if column == code_column:
+        order, rank = self.__rank(parent_level)
+        keys.append(rank[self.parents(level, parent_level)[ids]])
+        uniques.append(self.codes[parent_level][order])
+      else:
+        column_keys, column_uniques = pd.factorize(data[column], sort=True)
+        keys.append(column_keys)
+        uniques.append(np.asarray(column_uniques))
+    dims = [len(values) for values in uniques]
+    groups, inverse = np.unique(np.ravel_multi_index(keys, dims), return_inverse=True)
+    values = data[value_column].values
+    sums = np.bincount(inverse.ravel(), weights=values, minlength=len(groups))
+
+    result = pd.DataFrame({column: column_uniques[column_keys] for column, column_uniques, column_keys
+                           in zip(columns, uniques, np.unravel_index(groups, dims))})
+    result[value_column] = sums.round().astype(values.dtype) if np.issubdtype(values.dtype, np.integer) else sums
+    return result
+
+  # for each area at parent_level, the ids of the areas at level it contains are order[offsets[i]:offsets[i+1]]
+  def __child_index(self, level, parent_level):
+    key = (level, parent_level)
+    parents = self.parents(level, parent_level)
+    with self.__lock:
+      if key not in self.__children:
+        order = np.argsort(parents, kind="stable")
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(parents, minlength=len(self.codes[parent_level])))))
+        self.__children[key] = (order, offsets)
+      return self.__children[key]
+
+  # the ids sorted by area code, and the position of each id in that order
+  def __rank(self, level):
+    with self.__lock:
+      if level not in self.__ranks:
+        order = np.argsort(self.codes[level], kind="stable")
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        self.__ranks[level] = (order, rank)
+      return self.__ranks[level]
@@ -0,0 +1,338 @@
+"""
+Shared HTTP transport for all the data providers.
+A single session (per TLS configuration) is shared by every request, so connections are pooled and kept alive
+rather than a new TLS handshake being made for each request.
+Every HTTP exchange can be recorded to an on-disk store and later replayed from it without any network access
+(see configure), e.g. for deterministic runs on machines that can't reach the providers' sites.
+"""
+
+import io
+import os
+import ssl
+import gzip
+import json
+import zlib
+import shutil
+import hashlib
+import threading
+import warnings
+from pathlib import Path
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+import requests
+import urllib3
+from urllib3 import poolmanager
+
+# for locking downloads against other processes (not available on windows)
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+# some sites give a 403 error without a browser-like user agent
+USER_AGENT = "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:92.0) Gecko/20100101 Firefox/92.0"
+
+# maximum number of pooled connections per host
+POOL_SIZE = 16
+
+# default (connect, read) timeouts in seconds
+TIMEOUT = (15, 300)
+
+# record/replay: "off", "record" (every exchange is saved to the store) or "replay" (responses are served from the store)
+MODES = ["off", "record", "replay"]
+MODE = os.environ.get("UKCENSUSAPI_TRANSPORT_MODE", "off")
+STORE = os.environ.get("UKCENSUSAPI_TRANSPORT_STORE")
+
+# query parameters that don't affect the response, and aren't recorded (the API key)
+IGNORED_PARAMS = ["uid"]
+
+_sessions = {}
+_lock = threading.Lock()
+
+# serialises downloads to the same file (which share a temporary .part file) within this process
+_download_locks = {}
+
+# buffer size for copying and decoding data
+_CHUNK_SIZE = 1024*1024
+
+# workaround for apparent bug in later versions of openssl (e.g. 1.1.1f on ubuntu focal)
+# that causes this issue: https://github.com/virgesmith/UKCensusAPI/issues/48
+class _TLSAdapter(requests.adapters.HTTPAdapter):
+  def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+    """Create and initialize the urllib3 PoolManager."""
+    ctx = ssl.create_default_context()
+    ctx.set_ciphers('DEFAULT@SECLEVEL=1')
+    self.poolmanager = poolmanager.PoolManager(
+      num_pools=connections,
+      maxsize=maxsize,
+      block=block,
+      ssl_version=ssl.PROTOCOL_TLS,
+      ssl_context=ctx)
+
+def configure(pool_size=None, timeout=None, mode=None, store=None):
+  """
+  Sets the connection pool size, default timeout and/or record/replay mode. Existing sessions are closed and recreated
+  on next use. The mode and store can also be set using the UKCENSUSAPI_TRANSPORT_MODE and UKCENSUSAPI_TRANSPORT_STORE
+  environment variables.
+  Args:
+    pool_size: maximum number of pooled connections per host
+    timeout: default timeout in seconds, either a single value or a (connect, read) tuple
+    mode: "off", "record" (save every HTTP exchange to the store) or "replay" (serve every request from the store,
+      never using the network)
+    store: the directory in which exchanges are recorded
+  """
+  global POOL_SIZE, TIMEOUT, MODE, STORE
+  if mode is not None and mode not in MODES:
+    raise ValueError("transport mode must be one of %s" % MODES)
+  if pool_size is not None:
+    POOL_SIZE = pool_size
+  if timeout is not None:
+    TIMEOUT = timeout
+  if mode is not None:
+    MODE = mode
+  if store is not None:
+    STORE = str(store)
+  with _lock:
+    for session in _sessions.values():
+      session.close()
+    _sessions.clear()
+
+def session(legacy_tls=False):
+  """
+  Returns the shared session, creating it if necessary
+  Args:
+    legacy_tls: use the session that permits older TLS ciphers (required by some NRScotland servers)
+  """
+  with _lock:
+    if legacy_tls not in _sessions:
+      new_session = requests.Session()
+      new_session.headers.update({"User-Agent": USER_AGENT, "Accept-Encoding": "gzip, deflate"})
+      if legacy_tls:
+        # suppress ResourceWarning: unclosed <ssl.SSLSocket...
+        warnings.filterwarnings(action='ignore', category=ResourceWarning, message="unclosed <ssl.SSLSocket.*>")
+        new_session.mount("https://", _TLSAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE))
+      else:
+        new_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE))
+      new_session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE))
+      _sessions[legacy_tls] = new_session
+    return _sessions[legacy_tls]
+
+def get(url, timeout=None, legacy_tls=False, **kwargs):
+  """
+  HTTP GET using the shared session. Additional keyword arguments are passed to requests
+  Args:
+    url: the url
+    timeout: override the default timeout
+    legacy_tls: see session()
+  Returns:
+    a requests.Response
+  Raises requests.ConnectionError in replay mode if the url hasn't been recorded
+  """
+  stream = kwargs.get("stream", False)
+  if MODE == "replay":
+    return _replay(url, stream)
+  response = session(legacy_tls).get(url, timeout=timeout or TIMEOUT, **kwargs)
+  if MODE == "record":
+    # the (decoded) body is copied into the store a chunk at a time, and the recorded response returned in its place
+    with response:
+      if stream:
+        response.raw.decode_content = True
+      _record(url, response.status_code, response.headers, response.raw if stream else io.BytesIO(response.content))
+    return _replay(url, stream)
+  return response
+
+# content encodings we may receive (and can decode)
+_ENCODINGS = ["identity", "gzip", "deflate"]
+
+def _part_file(filename, encoding):
+  return Path("%s.%s.part" % (filename, encoding))
+
+def download(url, filename, timeout=None, legacy_tls=False, chunk_size=1024*1024, retries=3, progress=None, **kwargs):
+  """
+  Streams the response body of url into filename.
+  The (raw) data is written to a temporary .part file which is only moved to filename once complete and verified
+  against the Content-Length, so an interrupted transfer never leaves a truncated file in place. A failed transfer
+  is resumed from where it stopped (using a HTTP Range request), up to the specified number of retries, as is one
+  left over from a previous call. Concurrent downloads to the same filename, by any thread or process, are serialised
+  (using a .lock file alongside it), and if filename didn't exist but has been downloaded by the time the lock is
+  obtained, it isn't downloaded again.
+  If specified, progress(bytes_received, total_bytes) is called as each chunk is received (total_bytes may be None).
+  Raises requests.HTTPError on an error status, or requests.RequestException if the transfer can't be completed
+  """
+  with _lock:
+    download_lock = _download_locks.setdefault(str(filename), threading.Lock())
+  existed = os.path.isfile(str(filename))
+  with download_lock, open(str(filename) + ".lock", "a") as lock_file:
+    if fcntl:
+      fcntl.flock(lock_file, fcntl.LOCK_EX)
+    # completed by another thread or process while waiting for the lock
+    if not existed and os.path.isfile(str(filename)):
+      return
+    _download(url, filename, timeout, legacy_tls, chunk_size, retries, progress, **kwargs)
+
+def _download(url, filename, timeout, legacy_tls, chunk_size, retries, progress, **kwargs):
+  if MODE == "replay":
+    _replay_download(url, filename, progress)
+    return
+  headers = dict(kwargs.pop("headers", None) or {})
+  # look for partial data left by a previous attempt
+  encoding, offset = next(((enc, _part_file(filename, enc).stat().st_size) for enc in _ENCODINGS
+                           if _part_file(filename, enc).is_file()), (None, 0))
+  attempt = 0
+  while True:
+    request_headers = dict(headers, Range="bytes=%d-" % offset) if offset else headers
+    try:
+      # (not via get, which in record mode would store the raw, possibly partial, data; the file is recorded once complete)
+      with session(legacy_tls).get(url, timeout=timeout or TIMEOUT, stream=True, headers=request_headers, **kwargs) as response:
+        # range not satisfiable: the partial data is invalid, start again
+        if response.status_code == 416:
+          _part_file(filename, encoding).unlink()
+          encoding, offset = None, 0
+          continue
+        if MODE == "record" and response.status_code >= 400:
+          _record(url, response.status_code, response.headers, io.BytesIO(response.content))
+        response.raise_for_status()
+        response_encoding = response.headers.get("Content-Encoding", "identity").lower()
+        if response_encoding not in _ENCODINGS:
+          raise requests.exceptions.ContentDecodingError("%s: unsupported content encoding %s" % (url, response_encoding))
+        # server ignored the range, or the (resumed) data is encoded differently: start from scratch
+        if offset and (response.status_code != 206 or response_encoding != encoding):
+          _part_file(filename, encoding).unlink()
+          offset = 0
+          # (a partial response can't be used, request the whole lot)
+          if response.status_code == 206:
+            encoding = None
+            continue
+        encoding = response_encoding
+        expected = int(response.headers["Content-Length"]) + offset if "Content-Length" in response.headers else None
+        with open(str(_part_file(filename, encoding)), "ab" if offset else "wb") as fd:
+          # raw data, so the length can be checked and resumed transfers can be appended
+          received = offset
+          for chunk in response.raw.stream(chunk_size, decode_content=False):
+            fd.write(chunk)
+            received += len(chunk)
+            if progress:
+              progress(received, expected)
+      size = _part_file(filename, encoding).stat().st_size
+      if expected is not None and size != expected:
+        raise requests.exceptions.RequestException("%s: incomplete transfer (%d of %d bytes)" % (url, size, expected))
+      break
+    except requests.exceptions.HTTPError:
+      raise
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError):
+      attempt += 1
+      if attempt > retries:
+        raise
+      offset = _part_file(filename, encoding).stat().st_size if encoding and _part_file(filename, encoding).is_file() else 0
+
+  _decode(_part_file(filename, encoding), encoding, filename)
+
+  if MODE == "record":
+    with open(str(filename), "rb") as fd:
+      _record(url, 200, {}, fd)
+
+def _decode(part_file, encoding, filename):
+  """
+  Decompresses (if necessary) the downloaded data and moves it into place
+  """
+  if encoding == "identity":
+    os.replace(str(part_file), str(filename))
+    return
+  tmp_file = Path(str(part_file) + ".decoded")
+  if encoding == "gzip":
+    with gzip.open(str(part_file), "rb") as src, open(str(tmp_file), "wb") as dst:
+      shutil.copyfileobj(src, dst, _CHUNK_SIZE)
+  else:
+    # deflate should be zlib-wrapped but some servers send raw deflate
+    try:
+      _inflate(part_file, tmp_file, zlib.MAX_WBITS)
+    except zlib.error:
+      _inflate(part_file, tmp_file, -zlib.MAX_WBITS)
+  os.replace(str(tmp_file), str(filename))
+  part_file.unlink()
+
+def _inflate(src_file, dst_file, wbits):
+  """
+  Decompresses deflate data a chunk at a time
+  """
+  decompressor = zlib.decompressobj(wbits)
+  with open(str(src_file), "rb") as src, open(str(dst_file), "wb") as dst:
+    for chunk in iter(lambda: src.read(_CHUNK_SIZE), b""):
+      dst.write(decompressor.decompress(chunk))
+    dst.write(decompressor.flush())
+
+def _key(url):
+  """
+  The store key for a url, ignoring the order of the query parameters and any (see IGNORED_PARAMS) that don't affect
+  the response
+  """
+  parts = urlsplit(url)
+  query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in IGNORED_PARAMS)
+  return hashlib.sha256(urlunsplit(parts._replace(query=urlencode(query))).encode()).hexdigest()
+
+def _store_file(url):
+  if STORE is None:
+    raise ValueError("no transport store specified for %s mode" % MODE)
+  return Path(STORE) / (_key(url) + ".gz")
+
+def _record(url, status, headers, body):
+  """
+  Saves an exchange to the store: a gzipped file containing a line of json (the url, status and content type)
+  followed by the (decoded) response body, which is copied from the file-like object body in chunks
+  """
+  filename = _store_file(url)
+  filename.parent.mkdir(parents=True, exist_ok=True)
+  header = {"url": _strip_ignored(url), "status": status, "content-type": headers.get("Content-Type")}
+  tmp_file = filename.with_suffix(".%d.%d.tmp" % (os.getpid(), threading.get_ident()))
+  with gzip.open(str(tmp_file), "wb") as fd:
+    fd.write(json.dumps(header).encode() + b"\n")
+    shutil.copyfileobj(body, fd, _CHUNK_SIZE)
+  os.replace(str(tmp_file), str(filename))
+
+def _load(url):
+  """
+  Returns the recorded header for url and an open (binary) file positioned at the start of the body
+  """
+  filename = _store_file(url)
+  if not filename.is_file():
+    raise requests.exceptions.ConnectionError("%s: not in the transport store %s (replay mode)" % (_strip_ignored(url), STORE))
+  fd = gzip.open(str(filename), "rb")
+  return json.loads(fd.readline()), fd
+
+def _replay(url, stream=False):
+  """
+  Returns the recorded response for url. If streamed, the body is read from the store as it's consumed
+  """
+  header, fd = _load(url)
+  if stream:
+    content = fd
+  else:
+    with fd:
+      content = io.BytesIO(fd.read())
+  headers = {}
+  if header["content-type"]:
+    headers["Content-Type"] = header["content-type"]
+  response = requests.Response()
+  response.url = url
+  response.status_code = header["status"]
+  response.headers = requests.structures.CaseInsensitiveDict(headers)
+  response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+  response.raw = urllib3.HTTPResponse(body=content, headers=headers, status=header["status"], preload_content=False)
+  return response
+
+def _replay_download(url, filename, progress):
+  header, src = _load(url)
+  with src:
+    if header["status"] >= 400:
+      raise requests.exceptions.HTTPError("%d error for url: %s (replayed)" % (header["status"], _strip_ignored(url)))
+    part_file = _part_file(filename, "identity")
+    with open(str(part_file), "wb") as dst:
+      shutil.copyfileobj(src, dst, _CHUNK_SIZE)
+  size = part_file.stat().st_size
+  if progress:
+    progress(size, size)
+  os.replace(str(part_file), str(filename))
+
+def _strip_ignored(url):
+  parts = urlsplit(url)
+  query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in IGNORED_PARAMS]
+  return urlunsplit(parts._replace(query=urlencode(query)))
@@ -2,9 +2,19 @@
 Common utility/helpers
 """
 import os
+import threading
 from pathlib import Path
 import requests
 
+import ukcensusapi.transport as transport
+
+# pyarrow is optional, if not present no binary copies of cached data are made
+# (pickle isn't used instead, as loading a pickle from a shared cache directory could run arbitrary code)
+try:
+  import pyarrow.feather as feather
+except ImportError:
+  feather = None
+
 def _expand_home(path):
   """
   pathlib doesn't interpret ~/ as $HOME
@@ -33,9 +43,59 @@ def init_cache_dir(directory):
 
 def check_online(url, t=5):
   try:
-    headers = {'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:92.0) Gecko/20100101 Firefox/92.0'}
-    r = requests.get(url, timeout=t, headers=headers)
-    r.raise_for_status()
+    # don't download the body, we only need the status
+    with transport.get(url, timeout=t, stream=True) as r:
+      r.raise_for_status()
     return True
   except (requests.exceptions.RequestException) as error:
     return False
+
+def _columnar_filename(filename):
+  return Path(str(filename)).with_suffix(".arrow")
+
+def columnar_available():
+  """
+  Returns True if binary copies of data can be written, i.e. pyarrow is available
+  """
+  return feather is not None
+
+def write_columnar(data, filename):
+  """
+  Writes a typed, binary copy of a dataframe alongside the (text) file it was loaded from, in the Arrow IPC format.
+  Returns False if the data couldn't be written (including if pyarrow isn't available)
+  """
+  if not feather:
+    return False
+  columnar_file = _columnar_filename(filename)
+  # unique temporary file in case of concurrent writers
+  tmp_file = columnar_file.with_suffix(columnar_file.suffix + ".%d.%d.tmp" % (os.getpid(), threading.get_ident()))
+  try:
+    feather.write_feather(data.reset_index(drop=True), str(tmp_file))
+  except (ValueError, TypeError):
+    # e.g. mixed-type columns that arrow can't represent
+    if os.path.isfile(str(tmp_file)):
+      os.remove(str(tmp_file))
+    return False
+  os.replace(str(tmp_file), str(columnar_file))
+  return True
+
+def has_columnar(filename):
+  """
+  Returns True if there is a binary copy of the data in filename, that isn't older than the original file
+  """
+  if not feather:
+    return False
+  columnar_file = _columnar_filename(filename)
+  if not os.path.isfile(str(columnar_file)):
+    return False
+  return not os.path.isfile(str(filename)) or os.path.getmtime(str(columnar_file)) >= os.path.getmtime(str(filename))
+
+def read_columnar(filename, columns=None):
+  """
+  Reads the (memory-mapped) binary copy of the data in filename (written by write_columnar), optionally only the
+  specified columns.
+  Returns None if there is no binary copy, or if it's older than the original file
+  """
+  if not has_columnar(filename):
+    return None
+  return feather.read_table(str(_columnar_filename(filename)), columns=columns, memory_map=True).to_pandas()